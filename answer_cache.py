@@ -0,0 +1,120 @@
+import hashlib
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from utils import normalize_prompt
+
+def datasources_fingerprint(datasources: Dict[str, List[str]], hash_contents: bool = False) -> str:
+    """
+    Returns a fingerprint of the version of the datasources, that changes whenever a file is added, removed or modified.
+
+    Args:
+        datasources (Dict[str, List[str]]): the datasources paths and their relative files, like RFERag.datasources
+        hash_contents (bool): if True the content of the files is hashed, otherwise only their modification time and size are used
+
+    Returns:
+        str: the fingerprint of the datasources
+    """
+    fingerprint = hashlib.sha1()
+    for datasource in sorted(datasources):
+        for relative_path in sorted(datasources[datasource]):
+            file_path = datasource + relative_path
+            fingerprint.update(file_path.encode("utf-8"))
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                fingerprint.update(b"missing")
+                continue
+            if hash_contents:
+                with open(file_path, "rb") as file:
+                    for block in iter(lambda: file.read(1024 * 1024), b""):
+                        fingerprint.update(block)
+            else:
+                fingerprint.update(f"{stat.st_mtime_ns}-{stat.st_size}".encode("utf-8"))
+    return fingerprint.hexdigest()
+
+def cosine_similarity(a: List[float], b: List[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm > 0 else 0.0
+
+class AnswerCache:
+    """
+    Cache of the final answers of RFERag, keyed by the normalized question and the fingerprint of the datasources version,
+    so a cached answer is never returned after the files change.
+
+    Besides the exact match of the normalized question, if an embeddings model is given (any object with an
+    embed_query method, like the langchain embeddings, preferably a local one), a cached answer for a question with
+    similarity above the threshold is also returned.
+
+    The entries expire after the ttl, and the least recently used entries are evicted when the cache is full.
+    """
+    def __init__(self, max_entries: int = 256, ttl: float = None, embeddings = None, similarity_threshold: float = 0.95):
+        """
+        Args:
+            max_entries (int): the maximum number of cached answers
+            ttl (float): the time in seconds that an answer stays valid, if None the answers don't expire
+            embeddings: model used to find similar questions, if None only the exact normalized question is matched
+            similarity_threshold (float): the minimum cosine similarity for a question to be considered the same
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.embeddings = embeddings
+        self.similarity_threshold = similarity_threshold
+        # (normalized question, fingerprint) -> {"result": ..., "created_at": ..., "embedding": ...}
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def is_expired(self, entry: dict) -> bool:
+        return self.ttl is not None and time.monotonic() - entry["created_at"] > self.ttl
+
+    def remove_expired(self) -> None:
+        for key in [key for key, entry in self.entries.items() if self.is_expired(entry)]:
+            del self.entries[key]
+
+    def get(self, question: str, fingerprint: str) -> Optional[dict]:
+        """
+        Returns the cached result for the question on the given datasources version, or None if there is none.
+        """
+        key = (normalize_prompt(question), fingerprint)
+        with self.lock:
+            self.remove_expired()
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]["result"]
+            if self.embeddings is None:
+                return None
+            candidates = [(entry_key, entry) for entry_key, entry in self.entries.items() if entry_key[1] == fingerprint]
+
+        if len(candidates) == 0:
+            return None
+        embedding = self.embeddings.embed_query(key[0])
+        best_key, best_entry, best_similarity = None, None, self.similarity_threshold
+        for entry_key, entry in candidates:
+            similarity = cosine_similarity(embedding, entry["embedding"])
+            if similarity >= best_similarity:
+                best_key, best_entry, best_similarity = entry_key, entry, similarity
+        if best_entry is None:
+            return None
+        with self.lock:
+            if best_key in self.entries:
+                self.entries.move_to_end(best_key)
+        return best_entry["result"]
+
+    def put(self, question: str, fingerprint: str, result: dict) -> None:
+        normalized_question = normalize_prompt(question)
+        embedding = self.embeddings.embed_query(normalized_question) if self.embeddings is not None else None
+        key = (normalized_question, fingerprint)
+        with self.lock:
+            self.entries[key] = {"result": result, "created_at": time.monotonic(), "embedding": embedding}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,98 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple
+
+# the next node of a finished run
+END_NODE = "__end__"
+
+def serialize_state(state: dict) -> str:
+    """
+    Serializes the state as json. The futures of the pending explorations can't be saved, so only the file path
+    and the prompt of each one are kept, and the explorations are submitted again when the run is resumed.
+    """
+    state = dict(state)
+    state.pop("resume_node", None)
+    state["pending_explorations"] = [
+        [file_path, specific_prompt] for file_path, specific_prompt, _ in state.get("pending_explorations", [])
+    ]
+    return json.dumps(state, ensure_ascii=False, default=str)
+
+def deserialize_state(data: str) -> dict:
+    state = json.loads(data)
+    state["exploration_queue"] = [tuple(item) for item in state.get("exploration_queue", [])]
+    # the explorations without a future are submitted again by the exploration node
+    state["pending_explorations"] = [
+        (file_path, specific_prompt, None) for file_path, specific_prompt in state.get("pending_explorations", [])
+    ]
+    return state
+
+class CheckpointStore:
+    """
+    Durable store of the state of the runs of RFERag, saved after each node of the graph completes, so an
+    interrupted answer (a crash or a failed model call) can be resumed from the last completed node instead of
+    repeating the explorations already made.
+
+    Each checkpoint has the run id, a sequence number, the node that completed, the node that comes next and the state.
+    """
+    def __init__(self, db_path: str = "checkpoints.sqlite"):
+        """
+        Args:
+            db_path (str): the path to the SQLite database file, ":memory:" keeps the checkpoints only while the process runs
+        """
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS checkpoints (
+                    run_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    node TEXT NOT NULL,
+                    next_node TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (run_id, seq)
+                )
+            """)
+
+    def save(self, run_id: str, node: str, next_node: str, state: dict) -> None:
+        data = serialize_state(state)
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT MAX(seq) FROM checkpoints WHERE run_id = ?", (run_id,)).fetchone()
+            seq = 0 if row[0] is None else row[0] + 1
+            self.connection.execute(
+                "INSERT INTO checkpoints (run_id, seq, node, next_node, state, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (run_id, seq, node, next_node, data, time.time())
+            )
+
+    def load(self, run_id: str) -> Optional[Tuple[str, str, dict]]:
+        """
+        Returns the last checkpoint of the run as a tuple (node, next node, state), or None if the run has no checkpoints.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT node, next_node, state FROM checkpoints WHERE run_id = ? ORDER BY seq DESC LIMIT 1", (run_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        node, next_node, data = row
+        return node, next_node, deserialize_state(data)
+
+    def history(self, run_id: str) -> List[Tuple[int, str, str]]:
+        """
+        Returns the (seq, node, next node) of all the checkpoints of the run, in order.
+        """
+        with self.lock:
+            return self.connection.execute(
+                "SELECT seq, node, next_node FROM checkpoints WHERE run_id = ? ORDER BY seq", (run_id,)
+            ).fetchall()
+
+    def list_runs(self) -> List[str]:
+        with self.lock:
+            return [row[0] for row in self.connection.execute("SELECT DISTINCT run_id FROM checkpoints")]
+
+    def delete(self, run_id: str) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM checkpoints WHERE run_id = ?", (run_id,))
@@ -0,0 +1,122 @@
+import re
+import time
+from typing import Optional
+
+def words_novelty(previous_text: str, current_text: str) -> float:
+    """
+    Returns the fraction of the distinct words of the current text that are not in the previous text.
+    """
+    current_words = set(re.findall(r"\w+", current_text.lower()))
+    if len(current_words) == 0:
+        return 0.0
+    previous_words = set(re.findall(r"\w+", previous_text.lower()))
+    return len(current_words - previous_words) / len(current_words)
+
+class ExplorationController:
+    """
+    Decides when the exploration should stop before the fixed limits of RFERag, because more rounds are unlikely
+    to change the answer or because the question is out of its latency or token budget.
+
+    At each context evaluation the model reports its confidence that the notes answer the prompt and the coverage
+    of the information needed (see PydanticExploration), and the marginal information gain of the last round is
+    measured as the largest of the change of these scores and the fraction of new words in the notes.
+    The exploration stops when:
+        - the confidence (and the coverage, when reported) reaches its threshold after at least one exploration
+          round, even if the model still requests more files
+        - the information gain stays below min_info_gain for patience rounds
+        - another round would exceed the latency or token budget, estimated from the average of the previous rounds
+    """
+    def __init__(
+            self,
+            confidence_threshold: float = 0.85,
+            coverage_threshold: float = 0.8,
+            min_info_gain: float = 0.05,
+            patience: int = 2,
+            max_latency: float = None,
+            max_tokens: int = None
+            ):
+        """
+        Args:
+            confidence_threshold (float): the confidence (0 to 1) above which the exploration stops
+            coverage_threshold (float): the coverage (0 to 1) that must also be reached to stop by confidence
+            min_info_gain (float): the information gain (0 to 1) below which a round is considered unproductive
+            patience (int): the number of unproductive rounds in a row after which the exploration stops
+            max_latency (float): the maximum time in seconds to answer a question, if None there is no latency budget
+            max_tokens (int): the maximum number of prompt tokens to answer a question, if None there is no token budget
+        """
+        self.confidence_threshold = confidence_threshold
+        self.coverage_threshold = coverage_threshold
+        self.min_info_gain = min_info_gain
+        self.patience = max(patience, 1)
+        self.max_latency = max_latency
+        self.max_tokens = max_tokens
+
+    @staticmethod
+    def clamp_score(score) -> Optional[float]:
+        if score is None:
+            return None
+        try:
+            return min(max(float(score), 0.0), 1.0)
+        except (TypeError, ValueError):
+            return None
+
+    def record_round(self, state: dict, confidence: float = None, coverage: float = None) -> dict:
+        """
+        Adds the scores of the current context evaluation to state["exploration_scores"] and returns them.
+        """
+        scores = state.get("exploration_scores", [])
+        confidence = self.clamp_score(confidence)
+        coverage = self.clamp_score(coverage)
+        notes = state.get("dynamic_context", "")
+
+        info_gain = None
+        if len(scores) > 0:
+            previous = scores[-1]
+            # a drop of the scores also means that the last round changed the answer
+            deltas = [
+                abs(current - previous[name])
+                for name, current in [("confidence", confidence), ("coverage", coverage)]
+                if current is not None and previous.get(name) is not None
+            ]
+            # the scores of the model may not change while the notes do
+            info_gain = max(deltas + [words_novelty(state.get("evaluated_context", ""), notes)])
+
+        round_scores = {
+            "round": state.get("exploration_counter", 0),
+            "confidence": confidence,
+            "coverage": coverage,
+            "info_gain": info_gain,
+            "elapsed": time.time() - state.get("started_at", time.time()),
+            "prompt_tokens": sum(report.get("prompt_tokens", 0) for report in state.get("token_trace", []))
+        }
+        state["exploration_scores"] = scores + [round_scores]
+        state["evaluated_context"] = notes
+        return round_scores
+
+    def get_stop_reason(self, state: dict) -> Optional[str]:
+        """
+        Returns the reason to stop the exploration after the last recorded round, or None if it should go on.
+        """
+        scores = state.get("exploration_scores", [])
+        if len(scores) == 0:
+            return None
+        last = scores[-1]
+
+        # before the first exploration round the confidence only comes from the prompt
+        if last["round"] > 0 and last["confidence"] is not None and last["confidence"] >= self.confidence_threshold:
+            if last["coverage"] is None or last["coverage"] >= self.coverage_threshold:
+                return f"confidence {last['confidence']:.2f} reached the threshold"
+
+        gains = [round_scores["info_gain"] for round_scores in scores if round_scores["info_gain"] is not None]
+        if len(gains) >= self.patience and all(gain < self.min_info_gain for gain in gains[-self.patience:]):
+            return f"information gain below {self.min_info_gain} for {self.patience} round(s)"
+
+        # the cost of the next round is estimated as the average of the rounds so far
+        rounds = len(scores)
+        if self.max_latency is not None:
+            if last["elapsed"] + last["elapsed"] / rounds > self.max_latency:
+                return f"another round would exceed the latency budget of {self.max_latency} seconds"
+        if self.max_tokens is not None:
+            if last["prompt_tokens"] + last["prompt_tokens"] / rounds > self.max_tokens:
+                return f"another round would exceed the budget of {self.max_tokens} tokens"
+        return None
@@ -0,0 +1,244 @@
+import json
+import threading
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Callable, List
+
+def get_task_state(state: dict) -> dict:
+    """
+    Returns the part of the state used by the agents, that can be sent to other processes or hosts.
+    """
+    return {
+        "main_prompt": state.get("main_prompt", ""),
+        "dynamic_context": state.get("dynamic_context", ""),
+        "datasources": state.get("datasources", {}),
+        "token_trace": []
+    }
+
+def run_exploration_task(explorer, file_path: str, specific_prompt: str, task_state: dict) -> dict:
+    """
+    Explores the file with the explorer (any object with an explore_file method, like RFERag) and returns
+    the generated context with the token counts of the prompts.
+    """
+    context = explorer.explore_file(file_path, specific_prompt, task_state)
+    return {"context": context, "token_trace": task_state["token_trace"]}
+
+def resolve_task_result(task_future: Future, state: dict) -> Future:
+    """
+    Returns a future with only the context of the task result, adding its token counts to the trace of the state.
+    """
+    future = Future()
+    def on_done(task_future: Future):
+        try:
+            result = task_future.result()
+        except Exception as e:
+            future.set_exception(e)
+            return
+        trace = state.get("token_trace")
+        if trace is not None:
+            trace.extend(result.get("token_trace", []))
+        future.set_result(result["context"])
+    task_future.add_done_callback(on_done)
+    return future
+
+class ExplorationQueue(ABC):
+    """
+    Where RFERag sends the exploration of each file (the get_context_from_file of the agents). The future returned
+    by submit has the generated context.
+    """
+    @abstractmethod
+    def submit(self, file_path: str, specific_prompt: str, state: dict) -> Future:
+        pass
+
+    def shutdown(self) -> None:
+        pass
+
+class InProcessExplorationQueue(ExplorationQueue):
+    """
+    Explores the files in threads of the same process, the default of RFERag.
+    """
+    def __init__(self, explore_fn: Callable[[str, str, dict], str], max_workers: int = 4):
+        self.explore_fn = explore_fn
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit(self, file_path: str, specific_prompt: str, state: dict) -> Future:
+        return self.executor.submit(self.explore_fn, file_path, specific_prompt, state)
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False)
+
+# the explorer of each worker process, created by the factory when the process starts
+_process_explorer = None
+
+def _init_process_worker(explorer_factory: Callable) -> None:
+    global _process_explorer
+    _process_explorer = explorer_factory()
+
+def _run_process_task(file_path: str, specific_prompt: str, task_state: dict) -> dict:
+    return run_exploration_task(_process_explorer, file_path, specific_prompt, task_state)
+
+class MultiprocessingExplorationQueue(ExplorationQueue):
+    """
+    Explores the files in a pool of worker processes, so the parsing of the files (Excel, notebooks, image encoding)
+    is not limited to one CPU.
+
+    Each process creates its own explorer with explorer_factory, which must be a function defined at the top level
+    of a module (so it can be pickled), e.g.:
+
+        def create_worker_rag():
+            return RFERag(ChatOllama(model="qwen2.5:14b"), ChatOllama(model="qwen2.5:14b", format="json"), "prompts")
+
+        rag = RFERag(llm, structured_llm, "prompts", datasources, task_queue=MultiprocessingExplorationQueue(create_worker_rag))
+    """
+    def __init__(self, explorer_factory: Callable, max_workers: int = 4):
+        self.executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_process_worker,
+            initargs=(explorer_factory,)
+        )
+
+    def submit(self, file_path: str, specific_prompt: str, state: dict) -> Future:
+        task_future = self.executor.submit(_run_process_task, file_path, specific_prompt, get_task_state(state))
+        return resolve_task_result(task_future, state)
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False)
+
+def get_locality(file_path: str, datasources: List[str]) -> str:
+    """
+    Returns the datasource that contains the file, used to send its exploration to the workers where it lives.
+    """
+    for datasource in sorted(datasources, key=len, reverse=True):
+        if file_path.startswith(datasource):
+            return datasource
+    return None
+
+def get_tasks_key(namespace: str, locality: str = None) -> str:
+    return f"{namespace}:tasks:{locality if locality is not None else '*'}"
+
+def get_result_key(namespace: str, task_id: str) -> str:
+    return f"{namespace}:results:{task_id}"
+
+def get_workers_key(namespace: str, locality: str) -> str:
+    return f"{namespace}:workers:{locality}"
+
+class RedisExplorationQueue(ExplorationQueue):
+    """
+    Sends the explorations to workers in other processes or hosts through a Redis compatible server.
+
+    The tasks are pushed to a list for the datasource of the file, so they are explored by the workers that have
+    that datasource (see RedisExplorationWorker). The files outside the datasources, and the files of datasources
+    that no running worker has registered, go to a list shared by all the workers. The results are pushed by the
+    workers to a list for each task.
+
+    The datasource paths must be the same in RFERag and in the workers.
+
+    Example:
+        import redis
+        client = redis.Redis(host="localhost", port=6379)
+        rag = RFERag(llm, structured_llm, "prompts", datasources, task_queue=RedisExplorationQueue(client))
+    """
+    def __init__(self, client, namespace: str = "rfe", result_timeout: float = 300, max_waiting: int = 32):
+        """
+        Args:
+            client: the redis client (redis.Redis or any client with lpush, brpop, expire, set and exists)
+            namespace (str): the prefix of the keys
+            result_timeout (float): the maximum time in seconds to wait for the result of a task
+            max_waiting (int): the maximum number of results waited at the same time
+        """
+        self.client = client
+        self.namespace = namespace
+        self.result_timeout = result_timeout
+        # the results are waited with blocking pops, in threads
+        self.executor = ThreadPoolExecutor(max_workers=max_waiting)
+
+    def wait_result(self, task_id: str) -> dict:
+        item = self.client.brpop(get_result_key(self.namespace, task_id), timeout=int(self.result_timeout))
+        if item is None:
+            raise TimeoutError(
+                f"No worker answered the exploration task {task_id} within {self.result_timeout} seconds, "
+                f"check that a RedisExplorationWorker is running with the namespace '{self.namespace}'"
+            )
+        result = json.loads(item[1])
+        if "error" in result:
+            raise RuntimeError(result["error"])
+        return result
+
+    def submit(self, file_path: str, specific_prompt: str, state: dict) -> Future:
+        task_id = uuid.uuid4().hex
+        task = {
+            "task_id": task_id,
+            "file_path": file_path,
+            "specific_prompt": specific_prompt,
+            "state": get_task_state(state)
+        }
+        locality = get_locality(file_path, list(state.get("datasources", {}).keys()))
+        if locality is not None and not self.client.exists(get_workers_key(self.namespace, locality)):
+            # no running worker has this datasource, so any worker can take the task
+            locality = None
+        self.client.lpush(get_tasks_key(self.namespace, locality), json.dumps(task, ensure_ascii=False))
+        return resolve_task_result(self.executor.submit(self.wait_result, task_id), state)
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False)
+
+class RedisExplorationWorker:
+    """
+    Worker that explores the files of the tasks sent by RedisExplorationQueue.
+
+    The worker takes the tasks of the datasources it has locally before the tasks of the shared list, and while
+    it runs it keeps its datasources registered, so the queue sends their tasks to it.
+
+    Example:
+        worker = RedisExplorationWorker(redis.Redis(), create_worker_rag(), ["/data/base_conhecimento_1/"])
+        worker.run_forever()
+    """
+    def __init__(self, client, explorer, datasources: List[str] = [], namespace: str = "rfe", result_ttl: int = 3600, registration_ttl: int = 30):
+        """
+        Args:
+            client: the redis client
+            explorer: object with an explore_file method, like RFERag
+            datasources (List[str]): the datasource paths available to this worker, as they are in RFERag
+            namespace (str): the prefix of the keys, the same of the queue
+            result_ttl (int): the time in seconds that the results not collected are kept
+            registration_ttl (int): the time in seconds that the datasources stay registered after the worker
+                stops asking for tasks
+        """
+        self.client = client
+        self.explorer = explorer
+        self.namespace = namespace
+        self.result_ttl = result_ttl
+        self.registration_ttl = registration_ttl
+        self.datasources = datasources
+        self.tasks_keys = [get_tasks_key(namespace, datasource) for datasource in datasources] + [get_tasks_key(namespace)]
+        self.stop_event = threading.Event()
+
+    def run_once(self, timeout: int = 5) -> bool:
+        """
+        Explores the next task, waiting at most timeout seconds for one. Returns False if there was no task.
+        """
+        self.register(timeout)
+        item = self.client.brpop(self.tasks_keys, timeout=timeout)
+        if item is None:
+            return False
+        task = json.loads(item[1])
+        try:
+            result = run_exploration_task(self.explorer, task["file_path"], task["specific_prompt"], task["state"])
+        except Exception as e:
+            result = {"error": f"An error occured while exploring the file: {str(e)}"}
+        result_key = get_result_key(self.namespace, task["task_id"])
+        self.client.lpush(result_key, json.dumps(result, ensure_ascii=False, default=str))
+        self.client.expire(result_key, self.result_ttl)
+        return True
+
+    def register(self, timeout: int) -> None:
+        for datasource in self.datasources:
+            self.client.set(get_workers_key(self.namespace, datasource), "1", ex=max(self.registration_ttl, timeout + 1))
+
+    def run_forever(self, timeout: int = 5) -> None:
+        while not self.stop_event.is_set():
+            self.run_once(timeout)
+
+    def stop(self) -> None:
+        self.stop_event.set()
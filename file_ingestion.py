@@ -0,0 +1,348 @@
+import codecs
+import heapq
+import json
+import mmap
+import os
+import re
+import xml.etree.ElementTree as ET
+from typing import Dict, Iterable, List, Tuple
+
+try:
+    import yaml
+except ImportError:
+    # optional, without it the yaml files are sliced as plain text
+    yaml = None
+
+class UnreadableFileError(Exception):
+    """
+    The file can't be read as text (e.g. it is binary), so there is no need to send it to the language model.
+    """
+    pass
+
+BOMS = [
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16")
+]
+
+# words ignored when looking for the terms of the prompt in the file
+STOPWORDS = {
+    "what", "which", "where", "when", "does", "this", "that", "with", "from", "about", "there", "their", "have",
+    "file", "information", "know", "want", "these", "those", "into", "than", "then", "some", "more",
+    "the", "and", "for", "are", "how", "why", "who", "was", "did", "has", "its", "not", "any", "all", "you", "can",
+    "qual", "quais", "onde", "quando", "como", "sobre", "para", "esse", "essa", "este", "esta", "arquivo", "existe",
+    "que", "dos", "das", "uma", "por", "com", "nos", "não", "são"
+}
+
+def sniff_encoding(file_path: str, sample_size: int = 8192) -> str:
+    """
+    Detects the encoding of the file from its first bytes, without reading it all.
+
+    Returns:
+        str: the encoding of the file
+
+    Raises:
+        UnreadableFileError: if the file looks binary
+    """
+    with open(file_path, "rb") as file:
+        sample = file.read(sample_size)
+
+    for bom, encoding in BOMS:
+        if sample.startswith(bom):
+            return encoding
+    if b"\x00" in sample:
+        raise UnreadableFileError("The file is binary (it has null bytes), it can't be read as text")
+
+    control_chars = sum(1 for byte in sample if byte < 32 and byte not in (9, 10, 12, 13))
+    if len(sample) > 0 and control_chars / len(sample) > 0.1:
+        raise UnreadableFileError("The file is binary (it has too many control characters), it can't be read as text")
+
+    try:
+        # the sample may end in the middle of a character, so the decoding is not finalized
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+    try:
+        sample.decode("cp1252")
+        return "cp1252"
+    except UnicodeDecodeError:
+        return "latin-1"
+
+def get_prompt_terms(prompt: str, min_length: int = 3) -> List[str]:
+    """
+    Returns the words of the prompt used to find the relevant parts of the file.
+    The short words are kept when they have digits, since they are usually ids (e.g. "42" or "v2").
+    """
+    words = re.findall(r"\w+", (prompt or "").lower())
+    return list(dict.fromkeys(
+        word for word in words
+        if (len(word) >= min_length or any(char.isdigit() for char in word)) and word not in STOPWORDS
+    ))
+
+def get_term_weights(counts: Dict[str, int]) -> Dict[str, float]:
+    """
+    Returns the weight of each term from the number of times it was found, the rarer terms are more selective.
+    """
+    return {term: 1 / count for term, count in counts.items() if count > 0}
+
+def score_terms(matched_terms: Iterable[str], weights: Dict[str, float]) -> Tuple[int, float]:
+    """
+    Returns the relevance of a part of the file: the number of distinct terms it matches, and then their rarity.
+    """
+    matched_terms = set(matched_terms)
+    return (len(matched_terms), sum(weights.get(term, 0) for term in matched_terms))
+
+class TextIngestor:
+    """
+    Reads the text files for the TextReaderAgent with bounded memory, and only the parts relevant to the prompt.
+
+    - The encoding is sniffed from the first bytes, and binary files are rejected before reaching the language model.
+    - Files up to max_full_size are read entirely.
+    - Bigger files are memory mapped, and only their head, tail and the lines around the terms of the prompt
+      (like grep -C) are read.
+    - JSON, XML and YAML files bigger than max_structured_chars are parsed (when up to max_parse_size) and only the
+      subtrees whose keys or values match the terms of the prompt are kept, with an outline of the document.
+
+    When there are more matching parts than max_matches, the ones that match more distinct terms, and then the
+    rarer terms, are kept, so the generic words of the prompt don't crowd out the selective ones (like an id).
+    """
+    def __init__(
+            self,
+            max_full_size: int = 256 * 1024,
+            head_bytes: int = 8 * 1024,
+            tail_bytes: int = 8 * 1024,
+            context_lines: int = 2,
+            max_matches: int = 40,
+            max_range_bytes: int = 2 * 1024,
+            max_structured_chars: int = 20000,
+            max_parse_size: int = 20 * 1024 * 1024
+            ):
+        """
+        Args:
+            max_full_size (int): the size in bytes up to which the files are read entirely
+            head_bytes (int): the bytes read from the beginning of the bigger files
+            tail_bytes (int): the bytes read from the end of the bigger files
+            context_lines (int): the lines kept before and after each line that matches a term of the prompt
+            max_matches (int): the maximum number of matching line ranges or subtrees kept
+            max_range_bytes (int): the size in bytes above which the overlapping line ranges are not merged anymore
+            max_structured_chars (int): the size in characters above which only the relevant subtrees of JSON, XML and YAML files are kept
+            max_parse_size (int): the maximum size in bytes of the JSON, XML and YAML files that are parsed
+        """
+        self.max_full_size = max_full_size
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.context_lines = context_lines
+        self.max_matches = max_matches
+        self.max_range_bytes = max_range_bytes
+        self.max_structured_chars = max_structured_chars
+        self.max_parse_size = max_parse_size
+
+    def read(self, file_path: str, specific_prompt: str = None) -> str:
+        """
+        Returns the content of the file, or the parts relevant to the prompt for the big files.
+
+        Raises:
+            UnreadableFileError: if the file can't be read as text
+        """
+        encoding = sniff_encoding(file_path)
+        file_size = os.path.getsize(file_path)
+        terms = get_prompt_terms(specific_prompt)
+        extension = file_path.split(".")[-1].lower()
+
+        if extension in ["json", "xml", "yml", "yaml"] and file_size <= self.max_parse_size:
+            if file_size > self.max_structured_chars:
+                with open(file_path, "r", encoding=encoding, errors="replace") as file:
+                    text = file.read()
+                try:
+                    return self.extract_structured(text, extension, terms)
+                except Exception as e:
+                    # invalid documents are sliced as plain text
+                    print(f"Could not parse the file {file_path}: {str(e)}")
+
+        if file_size <= self.max_full_size:
+            with open(file_path, "r", encoding=encoding, errors="replace") as file:
+                return file.read()
+        return self.read_slices(file_path, encoding, file_size, terms)
+
+    def read_slices(self, file_path: str, encoding: str, file_size: int, terms: List[str]) -> str:
+        """
+        Reads the head, the tail and the lines that match the terms of the prompt of a memory mapped file.
+        """
+        with open(file_path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            head = mapped[:self.head_bytes].decode(encoding, errors="replace")
+            tail = mapped[max(file_size - self.tail_bytes, self.head_bytes):].decode(encoding, errors="replace")
+
+            matches = []
+            # the search over the bytes only works for the encodings compatible with ascii
+            if len(terms) > 0 and encoding not in ["utf-16", "utf-32"]:
+                # each term is a group, so the matched term is known from the group index
+                pattern = re.compile(b"|".join(b"(" + re.escape(term.encode(encoding, errors="ignore")) + b")" for term in terms), re.IGNORECASE)
+                search_start, search_end = self.head_bytes, max(file_size - self.tail_bytes, self.head_bytes)
+
+                # the first pass counts the terms, to weight the rarer ones
+                counts = dict.fromkeys(terms, 0)
+                for match in pattern.finditer(mapped, search_start, search_end):
+                    counts[terms[match.lastindex - 1]] += 1
+                weights = get_term_weights(counts)
+
+                # the second pass keeps the best max_matches ranges, in a heap to bound the memory
+                best_ranges = []
+                def keep_range(start: int, end: int, matched_terms: set):
+                    item = (score_terms(matched_terms, weights), -start, start, end)
+                    if len(best_ranges) < self.max_matches:
+                        heapq.heappush(best_ranges, item)
+                    else:
+                        heapq.heappushpop(best_ranges, item)
+
+                current = None
+                for match in pattern.finditer(mapped, search_start, search_end):
+                    start = mapped.rfind(b"\n", 0, match.start()) + 1
+                    end = match.end()
+                    for _ in range(self.context_lines):
+                        if start > 0:
+                            start = mapped.rfind(b"\n", 0, start - 1) + 1
+                    for _ in range(self.context_lines + 1):
+                        next_line = mapped.find(b"\n", end)
+                        end = next_line + 1 if next_line != -1 else file_size
+                    term = terms[match.lastindex - 1]
+                    if current is not None and start <= current[1] and end - current[0] <= self.max_range_bytes:
+                        current = (current[0], max(end, current[1]), current[2] | {term})
+                    else:
+                        if current is not None:
+                            keep_range(*current)
+                            # the lines already in the previous range are not repeated
+                            start = min(max(start, current[1]), end)
+                        current = (start, end, {term})
+                if current is not None:
+                    keep_range(*current)
+
+                # the kept ranges are shown in the order of the file
+                ranges = sorted((start, end) for _, _, start, end in best_ranges)
+                matches = [(start, mapped[start:end].decode(encoding, errors="replace")) for start, end in ranges]
+
+        content = f"[The file has {file_size} bytes, only its beginning, its end and the lines with the terms {terms} are shown]\n"
+        content += "[Beginning of the file]\n" + head + "\n"
+        for start, lines in matches:
+            content += f"[Lines around byte {start}]\n" + lines + "\n"
+        content += "[End of the file]\n" + tail
+        return content
+
+    def extract_structured(self, text: str, extension: str, terms: List[str]) -> str:
+        if extension == "xml":
+            root = ET.fromstring(text)
+            selected = self.select_xml(root, terms, root.tag)
+            outline = self.outline_xml(root)
+            rendered = [f"{path}:\n{ET.tostring(element, encoding='unicode')}" for path, element in selected]
+        else:
+            if extension == "json":
+                document = json.loads(text)
+            elif yaml is not None:
+                document = yaml.safe_load(text)
+            else:
+                raise ValueError("pyyaml is not installed")
+            selected = self.select_tree(document, terms, "$")
+            outline = json.dumps(self.outline_tree(document), ensure_ascii=False, indent=1)
+            rendered = [f"{path}:\n{json.dumps(value, ensure_ascii=False, indent=1, default=str)}" for path, value in selected]
+        rendered = self.rank_parts(rendered, terms)
+
+        content = f"[The document has {len(text)} characters, only its outline and the parts with the terms {terms} are shown]\n"
+        content += "[Outline]\n" + outline[:self.head_bytes] + "\n"
+        remaining = self.max_structured_chars
+        for part in rendered[:self.max_matches]:
+            if remaining <= 0:
+                content += "[More matching parts were omitted]\n"
+                break
+            content += part[:remaining] + "\n"
+            remaining -= len(part)
+        if len(rendered) == 0:
+            content += "[No part of the document matches the terms, the beginning of the document is shown]\n" + text[:self.head_bytes]
+        return content
+
+    @staticmethod
+    def rank_parts(parts: List[str], terms: List[str]) -> List[str]:
+        """
+        Sorts the parts by the number of distinct terms they match, and then by the rarity of the terms among the parts.
+        The parts with the same score keep the order of the document.
+        """
+        matched_terms = [{term for term in terms if term in part.lower()} for part in parts]
+        counts = {term: sum(1 for matched in matched_terms if term in matched) for term in terms}
+        weights = get_term_weights(counts)
+        order = sorted(range(len(parts)), key=lambda i: score_terms(matched_terms[i], weights), reverse=True)
+        return [parts[i] for i in order]
+
+    @staticmethod
+    def matches_terms(text, terms: List[str]) -> bool:
+        text = str(text).lower()
+        return any(term in text for term in terms)
+
+    def select_tree(self, node, terms: List[str], path: str) -> List[Tuple[str, object]]:
+        """
+        Returns the (path, subtree) of the outermost subtrees whose key or scalar value matches the terms.
+        """
+        selected = []
+        if isinstance(node, dict):
+            items = [(f"{path}.{key}", key, value) for key, value in node.items()]
+        elif isinstance(node, list):
+            items = [(f"{path}[{i}]", None, value) for i, value in enumerate(node)]
+        else:
+            return [(path, node)] if self.matches_terms(node, terms) else []
+
+        for item_path, key, value in items:
+            if key is not None and self.matches_terms(key, terms):
+                # the more specific matches inside the subtree are preferred to the whole subtree
+                children = self.select_tree(value, terms, item_path) if isinstance(value, (dict, list)) else []
+                if len(children) > 0:
+                    selected.extend(children)
+                else:
+                    selected.append((item_path, value))
+            elif isinstance(value, (dict, list)):
+                # the list items are kept entirely when any of their fields match, like a table row
+                children = self.select_tree(value, terms, item_path)
+                if isinstance(node, list) and len(children) > 0:
+                    selected.append((item_path, value))
+                else:
+                    selected.extend(children)
+            elif self.matches_terms(value, terms):
+                selected.append((item_path, value))
+        return selected
+
+    def outline_tree(self, node, depth: int = 0, max_depth: int = 3):
+        """
+        Returns the structure of the document: the keys of the objects and the size of the lists, up to max_depth.
+        """
+        if isinstance(node, dict):
+            if depth >= max_depth:
+                return f"object with {len(node)} keys"
+            return {key: self.outline_tree(value, depth + 1, max_depth) for key, value in node.items()}
+        if isinstance(node, list):
+            if len(node) == 0:
+                return "empty list"
+            return [f"list with {len(node)} items, like:", self.outline_tree(node[0], depth + 1, max_depth)]
+        return type(node).__name__
+
+    def select_xml(self, element: ET.Element, terms: List[str], path: str) -> List[Tuple[str, ET.Element]]:
+        selected = []
+        for i, child in enumerate(element):
+            child_path = f"{path}/{child.tag}[{i}]"
+            own_text = " ".join([child.tag, (child.text or "")] + [f"{key} {value}" for key, value in child.attrib.items()])
+            if self.matches_terms(own_text, terms):
+                selected.append((child_path, child))
+            else:
+                selected.extend(self.select_xml(child, terms, child_path))
+        return selected
+
+    def outline_xml(self, element: ET.Element, depth: int = 0, max_depth: int = 3) -> str:
+        tags = {}
+        for child in element:
+            tags[child.tag] = tags.get(child.tag, 0) + 1
+        outline = "  " * depth + f"<{element.tag}> with " + ", ".join(f"{count} <{tag}>" for tag, count in tags.items()) + "\n"
+        if depth < max_depth:
+            seen = set()
+            for child in element:
+                if child.tag not in seen and len(child) > 0:
+                    seen.add(child.tag)
+                    outline += self.outline_xml(child, depth + 1, max_depth)
+        return outline
@@ -1,42 +1,88 @@
 from langchain_core.language_models.base import BaseLanguageModel
 from langchain_core.messages import HumanMessage
 from pydantic import BaseModel, Field
-from utils import State, render_prompt, format_current_context, image_to_base64
+from utils import State, render_prompt, format_datasources, format_project_notes, image_to_base64
+from prompt_assembly import assemble_prompt, PromptCacheMetrics
+from token_budget import TokenBudget, record_token_report
+from file_ingestion import TextIngestor, UnreadableFileError
 import json
-from typing import List
+import os
+from typing import List, Dict, Iterable
 
 class FileInteractionAgent:
+    # set by RFERag, records the prompt cache usage reported in the responses
+    prompt_cache_metrics: PromptCacheMetrics = None
+    # set by RFERag, keeps the prompts within the context window of the agent model
+    token_budget: TokenBudget = None
+
     def get_context_from_file(self, specific_prompt: str, file_path: str, state: State) -> str:
         pass
 
+    def record_response(self, response):
+        if self.prompt_cache_metrics is not None:
+            self.prompt_cache_metrics.record(response)
+        return response
+
+    def record_structured_response(self, result):
+        """
+        Records the raw message of a structured output invoked with include_raw=True, and returns the parsed output.
+        """
+        if result is None:
+            return None
+        self.record_response(result["raw"])
+        return result["parsed"]
+
+    def render_within_budget(self, prompt_path: str, prompt_variables: dict, trimmable: List[str], state: State = None, file_path: str = None) -> str:
+        """
+        Renders the prompt, trimming the trimmable variables (the first one is the lowest priority) when it doesn't fit
+        the token budget. The token counts are added to the answer trace of the state.
+        """
+        if self.token_budget is None:
+            return render_prompt(prompt_path, prompt_variables)
+        prompt, report = self.token_budget.fit(
+            lambda variables: render_prompt(prompt_path, variables),
+            prompt_variables,
+            trimmable,
+            name=os.path.basename(prompt_path)
+        )
+        if state is not None:
+            report["file_path"] = file_path
+            record_token_report(state, report)
+        return prompt
+
 class TextReaderAgent(FileInteractionAgent):
     """
     Agent responsible to read a given text file and get the relevant information from it.
     """
-    def __init__(self, llm: BaseLanguageModel, prompt_path: str, treat_errors: bool = True):
+    def __init__(self, llm: BaseLanguageModel, prompt_path: str, treat_errors: bool = True, ingestor: TextIngestor = None):
         """
         Args:
             llm (BaseLanguageModel): the language model to be used to generate the answer
             prompt_path (str): the path to the prompt file
             treat_errors (bool): if True, the agent will treat errors and return a message instead of raising an exception
+            ingestor (TextIngestor): reads the files, detecting their encoding and keeping only the parts relevant to the prompt of the big files
         """
         self.llm = llm
         self.prompt_path = prompt_path
         self.treat_errors = treat_errors
+        self.ingestor = ingestor if ingestor is not None else TextIngestor()
 
-    def get_file_content(self, file_path: str) -> str:
+    def get_file_content(self, file_path: str, specific_prompt: str = None) -> str:
         try:
-            with open(file_path, 'r', encoding="utf-8") as file:
-                return file.read()
+            return self.ingestor.read(file_path, specific_prompt)
         except Exception as e:
             print(f"An error occurred while reading the file: {str(e)}")
             print(file_path)
             raise e
     def get_context_from_file(self, specific_prompt: str, file_path: str, state: State) -> str:
         main_prompt = state.get('main_prompt', 'there is no main prompt')
-        current_context = format_current_context(state)
         try:
-            file_content = self.get_file_content(file_path)
+            file_content = self.get_file_content(file_path, specific_prompt)
+        except UnreadableFileError as e:
+            # there is nothing for the language model to read
+            if self.treat_errors:
+                return f"The file could not be read: {str(e)}"
+            raise e
         except Exception as e:
             if self.treat_errors:
                 file_content = f"An error occurred while reading the file, if you can get any insight of why this error happened give as feedback in the answer so that the problem wont happen again: {str(e)}"
@@ -45,12 +91,13 @@ class TextReaderAgent(FileInteractionAgent):
 
         prompt_variables = {
             "main_prompt" : main_prompt,
-            "current_context" : current_context,
+            "datasources" : format_datasources(state),
+            "project_notes" : format_project_notes(state),
             "file_path": file_path,
             "specific_prompt" : specific_prompt,
             "file_content" : file_content
         }
-        prompt = render_prompt(self.prompt_path, prompt_variables)
+        prompt = self.render_within_budget(self.prompt_path, prompt_variables, ["project_notes", "file_content"], state, file_path)
 
         try:
             result = self.generate_answer(prompt)
@@ -63,10 +110,12 @@ class TextReaderAgent(FileInteractionAgent):
         return result
     
     def generate_answer(self, prompt):
-        return self.llm.invoke(prompt).content
+        return self.record_response(self.llm.invoke(prompt)).content
 
-from pandasql import sqldf
+from pandasql import PandaSQL
 import pandas as pd
+from sql_tools import references_table, selects_all_columns, referenced_columns, pushdown_filters, replace_table_names, validate_query, schema_fingerprint, QueryResultGovernor, SQLPlanCache
+from table_statistics import StatisticsStore, TableStatistics
 
 class DataReaderAgent(FileInteractionAgent):
     """
@@ -74,13 +123,40 @@ class DataReaderAgent(FileInteractionAgent):
 
     This class uses the pandasql library to execute the queries generated by the language model.
     It also expects that the agent has structured output, to use pydantic to define the format of the answer.
+
+    The file is read in two phases: first only the schema is read (parquet metadata, the csv header and a sample
+    of rows, or the xlsx sheet list), and after the query is generated only the tables (sheets) and columns
+    referenced by the query are loaded, with predicate pushdown when the format allows it.
+
+    The table summaries are built from column statistics computed once per file version (see table_statistics.py).
     """
-    def __init__(self, llm: BaseLanguageModel, prompt_path: str, treat_errors: bool = True):
+    def __init__(
+            self,
+            llm: BaseLanguageModel,
+            prompt_path: str,
+            treat_errors: bool = True,
+            sample_rows: int = 5,
+            statistics_store: StatisticsStore = None,
+            summary_max_tokens: int = 1500,
+            chunk_size: int = 100000,
+            result_governor: QueryResultGovernor = None,
+            repair_prompt_path: str = None,
+            max_query_retries: int = 2,
+            plan_cache: SQLPlanCache = None
+            ):
         """
         Args:
             llm (BaseLanguageModel): the language model to be used to generate the answer
             prompt_path (str): the path to the prompt file
             treat_errors (bool): if True, the agent will treat errors and return a message instead of raising an exception
+            sample_rows (int): the number of rows read in the schema phase, to show as an example to the language model
+            statistics_store (StatisticsStore): where the column statistics are stored, if None they are kept in memory
+            summary_max_tokens (int): the maximum number of tokens of the summary of each table
+            chunk_size (int): the number of rows read at a time while computing the statistics
+            result_governor (QueryResultGovernor): limits the size of the query results added to the context
+            repair_prompt_path (str): the path to the prompt file used to fix invalid queries, if None the error is appended to the original prompt
+            max_query_retries (int): the maximum number of times an invalid query is sent back to be fixed
+            plan_cache (SQLPlanCache): cache of the queries already generated for a prompt and schema, if None a new in memory cache is used
         """
 
         # Define the format of the answer as a dict like this:
@@ -89,116 +165,369 @@ class DataReaderAgent(FileInteractionAgent):
         # }
         class PydanticQuery(BaseModel):
             query: str = Field(description="Generated SQLite query")
-        
+
         self.llm = llm
-        self.query_gen_llm = llm.with_structured_output(PydanticQuery)
-        
+        # the raw message is kept to record the prompt cache usage
+        self.query_gen_llm = llm.with_structured_output(PydanticQuery, include_raw=True)
+
         self.prompt_path = prompt_path
         self.treat_errors = treat_errors
+        self.sample_rows = sample_rows
+        self.statistics_store = statistics_store if statistics_store is not None else StatisticsStore()
+        self.summary_max_tokens = summary_max_tokens
+        self.chunk_size = chunk_size
+        self.result_governor = result_governor if result_governor is not None else QueryResultGovernor()
+        self.repair_prompt_path = repair_prompt_path
+        self.max_query_retries = max_query_retries
+        self.plan_cache = plan_cache if plan_cache is not None else SQLPlanCache()
+
+    @staticmethod
+    def format_column_name(column) -> str:
+        """
+        Formats the column name as lower case and with underscores instead of spaces.
+        """
+        return str(column).replace(' ', '_').lower()
+
+    @staticmethod
+    def get_table_name(file_path: str, sheet_name: str = None) -> str:
+        """
+        Returns the name of the table that represents the file (or the sheet of the file) in the queries.
+        """
+        table_name = file_path.split('/')[-1].split('.')[0]
+        if sheet_name is not None:
+            table_name += '_' + str(sheet_name)
+        return table_name.replace(' ', '_').lower() + '_table'
+
+    def format_dataframe(self, df: pd.DataFrame) -> pd.DataFrame:
+        # transform column names to lower case and replace spaces with underscores
+        df.columns = [self.format_column_name(col) for col in df.columns]
+        for col in df.columns:
+            if df[col].dtype == 'object':
+                df[col] = df[col].astype(str)
+        return df
 
-    def get_file_content(self, file_path: str) -> pd.DataFrame:
+    def get_file_schema(self, file_path: str) -> dict:
+        """
+        Reads only the schema of the file, without loading all its content.
+
+        Args:
+            file_path (str): the path to the file
+
+        Returns:
+            dict: a dictionary mapping the table names to their description, like:
+                {
+                    "table_name": {
+                        "sheet_name": the sheet name for xlsx files, or None,
+                        "columns": {"formatted_column_name": "original column name", ...},
+                        "sample": a pd.DataFrame with the first rows of the table,
+                        "num_rows": the number of rows from the metadata of the file, or None if it has no metadata (csv)
+                    },
+                    ...
+                }
+        """
+        tables = {}
+        if file_path.endswith('.csv'):
+            sample = pd.read_csv(file_path, nrows=self.sample_rows)
+            tables[self.get_table_name(file_path)] = {
+                "sheet_name": None,
+                "columns": {self.format_column_name(col): col for col in sample.columns},
+                "sample": self.format_dataframe(sample),
+                "num_rows": None
+            }
+        elif file_path.endswith('.xlsx'):
+            with pd.ExcelFile(file_path) as workbook:
+                for i, sheet_name in enumerate(workbook.sheet_names):
+                    # the dimensions are read before the sample, since pandas resets them when parsing
+                    num_rows = self.get_sheet_num_rows(workbook, sheet_name)
+                    sample = workbook.parse(sheet_name, nrows=self.sample_rows)
+                    # the first sheet keeps the file table name, the others are named after the sheet
+                    table_name = self.get_table_name(file_path, None if i == 0 else sheet_name)
+                    tables[table_name] = {
+                        "sheet_name": sheet_name,
+                        "columns": {self.format_column_name(col): col for col in sample.columns},
+                        "sample": self.format_dataframe(sample),
+                        "num_rows": num_rows
+                    }
+        elif file_path.endswith('.parquet'):
+            import pyarrow.parquet as pq
+            parquet_file = pq.ParquetFile(file_path)
+            columns = parquet_file.schema_arrow.names
+            batch = next(parquet_file.iter_batches(batch_size=self.sample_rows), None)
+            sample = batch.to_pandas() if batch is not None else pd.DataFrame(columns=columns)
+            tables[self.get_table_name(file_path)] = {
+                "sheet_name": None,
+                "columns": {self.format_column_name(col): col for col in columns},
+                "sample": self.format_dataframe(sample),
+                "num_rows": parquet_file.metadata.num_rows
+            }
+        else:
+            raise ValueError(f"Unsupported file format: {file_path}")
+
+        return tables
+
+    @staticmethod
+    def get_sheet_num_rows(workbook: pd.ExcelFile, sheet_name: str) -> int:
+        """
+        Returns the number of rows of the sheet (without the header) from its dimensions, without reading it,
+        or None if the sheet has no dimensions.
+        """
+        try:
+            max_row = workbook.book[sheet_name].max_row
+        except Exception:
+            return None
+        return max(max_row - 1, 0) if max_row is not None else None
+
+    def get_file_content(self, file_path: str, columns: List[str] = None, sheet_name = 0, filters: list = None) -> pd.DataFrame:
         """
         Reads a file and returns its content as a pandas dataframe with the columns
         formatted as lower case and with underscores instead of spaces.
 
         Args:
             file_path (str): the path to the file
+            columns (List[str]): the original names of the columns to be loaded, if None all the columns are loaded
+            sheet_name: the sheet to be loaded for xlsx files, the first one by default
+            filters (list): filters to be applied while reading parquet files, in the pandas.read_parquet format
 
         Returns:
             pd.DataFrame: the content of the file as a pandas dataframe
         """
         if file_path.endswith('.csv'):
-            df = pd.read_csv(file_path)
+            df = pd.read_csv(file_path, usecols=columns)
         elif file_path.endswith('.xlsx'):
-            df = pd.read_excel(file_path)
+            df = pd.read_excel(file_path, sheet_name=sheet_name, usecols=columns)
         elif file_path.endswith('.parquet'):
-            df = pd.read_parquet(file_path)
+            try:
+                df = pd.read_parquet(file_path, columns=columns, filters=filters)
+            except Exception:
+                if filters is None:
+                    raise
+                # the filter could not be applied (e.g. type mismatch), the query will filter the data anyway
+                df = pd.read_parquet(file_path, columns=columns)
         else:
             raise ValueError(f"Unsupported file format: {file_path}")
-        
-        # transform column names to lower case and replace spaces with underscores
-        df.columns = [col.replace(' ', '_').lower() for col in df.columns]
-        for col in df.columns:
-            if df[col].dtype == 'object':
-                df[col] = df[col].astype(str)
-        
-        return df
 
-    def get_dataframe_summary(self, df: pd.DataFrame, table_name) -> str:
+        return self.format_dataframe(df)
+
+    def load_tables(self, file_path: str, schema: dict, query: str, project_columns: bool = True) -> Dict[str, pd.DataFrame]:
         """
-        Returns a summary of the dataframe treating it as a table.
+        Loads only the tables and columns of the file that are referenced by the query.
 
         Args:
-            df (pd.DataFrame): the dataframe to be summarized
+            file_path (str): the path to the file
+            schema (dict): the schema of the file, as returned by get_file_schema
+            query (str): the query that will be executed
+            project_columns (bool): if False, all the columns of the referenced tables are loaded
+
+        Returns:
+            Dict[str, pd.DataFrame]: a dictionary mapping the table names to the loaded dataframes
+        """
+        used_tables = [table_name for table_name in schema if references_table(query, table_name)]
+        if len(used_tables) == 0:
+            # let the query execution report the problem with the table name
+            used_tables = [next(iter(schema))]
+
+        tables = {}
+        for table_name in used_tables:
+            table = schema[table_name]
+            columns = None
+            filters = None
+            if project_columns and not selects_all_columns(query):
+                columns = referenced_columns(query, list(table["columns"].keys()))
+                if len(columns) == 0:
+                    # queries like "SELECT COUNT(*)" still need the rows, so the first column is loaded
+                    columns = list(table["columns"].keys())[:1]
+                if len(used_tables) == 1 and file_path.endswith('.parquet'):
+                    filters = pushdown_filters(query, columns)
+                    if filters is not None:
+                        filters = [(table["columns"][col], op, value) for col, op, value in filters]
+                columns = [table["columns"][col] for col in columns]
+
+            sheet_name = table["sheet_name"] if table["sheet_name"] is not None else 0
+            tables[table_name] = self.get_file_content(file_path, columns=columns, sheet_name=sheet_name, filters=filters)
+        return tables
+
+    def run_query(self, query: str, tables: Dict[str, pd.DataFrame]) -> str:
+        """
+        Executes the query over the given tables and renders the result within the limits of the result governor.
+        Each table name in the query is replaced by a variable name, so names that are not valid SQL identifiers can also be used.
+        """
+        table_variables = {table_name: f"local_df_variable_{i}" for i, table_name in enumerate(tables)}
+        env = {table_variables[table_name]: df for table_name, df in tables.items()}
+
+        # the tables are written to the database only once, even if the governor executes more than one query
+        pandasql = PandaSQL(persist=True)
+        def execute(sql: str) -> pd.DataFrame:
+            return pandasql(replace_table_names(sql, table_variables), env)
+
+        return self.result_governor.run(query, execute)
+
+    def iter_table_chunks(self, file_path: str, table: dict) -> Iterable[pd.DataFrame]:
+        """
+        Reads the whole table in chunks, with the column names formatted but without converting the values,
+        so the statistics can count the null values.
+        """
+        if file_path.endswith('.csv'):
+            chunks = pd.read_csv(file_path, chunksize=self.chunk_size)
+        elif file_path.endswith('.parquet'):
+            import pyarrow.parquet as pq
+            chunks = (batch.to_pandas() for batch in pq.ParquetFile(file_path).iter_batches(batch_size=self.chunk_size))
+        else:
+            raise ValueError(f"Unsupported file format: {file_path}")
+
+        for chunk in chunks:
+            chunk.columns = [self.format_column_name(col) for col in chunk.columns]
+            yield chunk
+
+    def get_table_statistics(self, file_path: str, schema: dict) -> Dict[str, TableStatistics]:
+        """
+        Returns the statistics of each table of the file, they are computed only once for each version of the file.
+        The xlsx files can't be read in chunks, so reading all their sheets would undo the lazy loading of the sheets,
+        and their summaries are built from the sample rows instead.
+        """
+        if file_path.endswith('.xlsx'):
+            return {}
+        def compute_statistics():
+            return {
+                table_name: TableStatistics.from_chunks(self.iter_table_chunks(file_path, table))
+                for table_name, table in schema.items()
+            }
+        return self.statistics_store.get_statistics(file_path, compute_statistics)
+
+    def get_dataframe_summary(self, df: pd.DataFrame, table_name, statistics: TableStatistics = None, num_rows: int = None) -> str:
+        """
+        Returns a summary of the dataframe treating it as a table, limited to summary_max_tokens.
+
+        Args:
+            df (pd.DataFrame): a sample of the table, shown as an example
             table_name (str): the name of the table
+            statistics (TableStatistics): the statistics of the table, if None only the types of the columns are
+                inferred from df, since its values are not representative of the table
+            num_rows (int): the number of rows of the table, used when there are no statistics
 
         Returns:
             str: the summary of the dataframe
         """
+        if statistics is None:
+            statistics = TableStatistics.from_chunks([df])
+            statistics.num_rows = num_rows
+            return statistics.render(table_name, self.summary_max_tokens, df.head(self.sample_rows), from_sample=True)
+        return statistics.render(table_name, self.summary_max_tokens, df.head(self.sample_rows))
 
-        summary = f"""
-        summary of the table {table_name}: {df.shape[0]} rows and {df.shape[1]} columns
+    @staticmethod
+    def get_schema_columns(schema: dict) -> Dict[str, List[str]]:
+        return {table_name: list(table["columns"].keys()) for table_name, table in schema.items()}
 
-        columns:
+    def execute_query(self, file_path: str, schema: dict, query: str) -> str:
         """
-        for col in df.columns:
-            column_type = df[col].dtype
-            if column_type == 'object':
-                column_type = 'string'
-            
-            if column_type in ['int64', 'float64']:
-                extra = f", min: {df[col].min()}, max: {df[col].max()}"
-            else:
-                extra = ""
+        Executes the query, loading only the tables and columns it needs.
+        """
+        try:
+            return self.run_query(query, self.load_tables(file_path, schema, query))
+        except Exception:
+            # the column detection may have missed some column, retry loading all of them
+            return self.run_query(query, self.load_tables(file_path, schema, query, project_columns=False))
+
+    def validate_and_repair(self, query: str, schema: dict, prompt: str, prompt_variables: dict, state: State = None, file_path: str = None) -> tuple:
+        """
+        Validates the query against the schema of the file, and while it is not valid asks the language model
+        to fix it, up to max_query_retries times. This way the errors are fixed inside the agent, instead of
+        going through another round of exploration.
 
-            summary += f"{col} ({column_type})" + extra + "\n"
+        Args:
+            query (str): the generated query
+            schema (dict): the schema of the file, as returned by get_file_schema
+            prompt (str): the prompt used to generate the query
+            prompt_variables (dict): the variables used to render the prompt
+            state (State): the state where the token counts of the repair prompts are added
+            file_path (str): the path to the file, added to the token counts
 
-        summary += f"""
-        the first 5 rows are:
-        {df.head()}
+        Returns:
+            tuple: the last generated query and the validation error, or None if the query is valid
         """
-        return summary
+        error = validate_query(query, self.get_schema_columns(schema))
+        retries = 0
+        while error is not None and retries < self.max_query_retries:
+            retries += 1
+            if self.repair_prompt_path is not None:
+                # only the variables of the repair prompt, so the token counts of its sections are not inflated
+                repair_variables = {
+                    "table_name": prompt_variables["table_name"],
+                    "table_summary": prompt_variables["table_summary"],
+                    "specific_prompt": prompt_variables["specific_prompt"],
+                    "failed_query": query,
+                    "error": error
+                }
+                repair_prompt = self.render_within_budget(self.repair_prompt_path, repair_variables, ["table_summary"], state, file_path)
+            else:
+                repair_prompt = prompt + f"\n\nThe query '{query}' is not valid, the error was: '{error}'. Answer with a fixed query."
+            query = self.generate_answer(repair_prompt)
+            error = validate_query(query, self.get_schema_columns(schema))
+        return query, error
 
     def get_context_from_file(self, specific_prompt: str, file_path: str, state: State) -> str:
         main_prompt = state.get('main_prompt', 'there is no main prompt')
-        current_context = format_current_context(state)
-        table_name = file_path.split('/')[-1].split('.')[0]
-        table_name = table_name.replace(' ', '_').lower() + '_table'
         try:
-            local_df_variable = self.get_file_content(file_path)
+            schema = self.get_file_schema(file_path)
         except Exception as e:
             if self.treat_errors:
                 return f"An error occurred while reading the file, if you can get any insight of why this error happened give as feedback in the answer so that the problem wont happen again: {str(e)}"
             else:
                 raise e
-        
-        table_summary = self.get_dataframe_summary(local_df_variable, table_name)
+
+        try:
+            statistics = self.get_table_statistics(file_path, schema)
+        except Exception as e:
+            # the summary can still be built from the sample rows
+            print(f"An error occurred while computing the statistics of the file: {str(e)}")
+            statistics = {}
+
+        table_name = next(iter(schema))
+        table_summary = "\n".join(
+            self.get_dataframe_summary(table["sample"], name, statistics.get(name), table.get("num_rows")) for name, table in schema.items()
+        )
 
         prompt_variables = {
             "main_prompt" : main_prompt,
-            "current_context" : current_context,
+            "datasources" : format_datasources(state),
+            "project_notes" : format_project_notes(state),
             "file_path": file_path,
             "table_name": table_name,
+            "other_tables": ", ".join(list(schema)[1:]),
             "table_summary": table_summary,
             "specific_prompt" : specific_prompt
         }
-        prompt = render_prompt(self.prompt_path, prompt_variables)
 
         try:
-            generated_query = self.generate_answer(prompt)
+            # the same prompt over the same schema reuses the query, even if the data changed
+            fingerprint = schema_fingerprint(self.get_schema_columns(schema))
+            generated_query = self.plan_cache.get(file_path, specific_prompt, fingerprint)
+            result = None
+            if generated_query is not None and validate_query(generated_query, self.get_schema_columns(schema)) is None:
+                try:
+                    result = self.execute_query(file_path, schema, generated_query)
+                except Exception as e:
+                    # the cached query doesn't work anymore, a new one is generated in this same call
+                    print(f"The cached query failed, generating a new one: {str(e)}")
+                    self.plan_cache.remove(specific_prompt, fingerprint)
+
+            if result is None:
+                # the prompt is only rendered (and counted in the token trace) when a query has to be generated
+                prompt = self.render_within_budget(self.prompt_path, prompt_variables, ["project_notes", "table_summary"], state, file_path)
+                generated_query = self.generate_answer(prompt)
+                generated_query, validation_error = self.validate_and_repair(generated_query, schema, prompt, prompt_variables, state, file_path)
+
+                try:
+                    if validation_error is not None:
+                        raise ValueError(f"the query is not valid even after {self.max_query_retries} attempts to fix it: {validation_error}")
+                    result = self.execute_query(file_path, schema, generated_query)
+                    self.plan_cache.put(file_path, specific_prompt, fingerprint, generated_query)
+                except Exception as e:
+                    self.plan_cache.remove(specific_prompt, fingerprint)
+                    if self.treat_errors:
+                        result = f"An error occurred while executing the query: {str(e)}\n\nPlease consider giving feedback on the answer so that the problem won't happen again."
+                    else:
+                        raise e
 
-            # format the query, substituting the table name
-            query = generated_query.replace(table_name, 'local_df_variable')
-            
-            # execute the query, this will execute the query on the local_df_variable table
-            try:
-                result = sqldf(query, locals())
-            except Exception as e:
-                if self.treat_errors:
-                    result = f"An error occurred while executing the query: {str(e)}\n\nPlease consider giving feedback on the answer so that the problem won't happen again."
-                else:
-                    raise e
-            
             # formating the result to output it as a resulting context generated from the file
             result = f"""
             {table_summary}
@@ -217,16 +546,16 @@ class DataReaderAgent(FileInteractionAgent):
                 result = f"An error occured while generating the answer: {str(e)}"
             else:
                 raise e
-            
+
         return result
-    
+
     def generate_answer(self, prompt):
         """
         Generates a query based on the given prompt.
         """
-        answer = self.query_gen_llm.invoke(prompt)
+        answer = self.record_structured_response(self.query_gen_llm.invoke(prompt))
         if answer is None:
-            answer = self.llm.invoke(prompt)
+            answer = self.record_response(self.llm.invoke(prompt))
             answer = json.loads(answer.content)
             query = answer['query']
         else:
@@ -263,7 +592,8 @@ class NotebookReaderAgent(FileInteractionAgent):
         else:
             self.vision_llm = vision_llm
 
-        self.structured_output_llm = llm.with_structured_output(PydanticNotebookContent)
+        # the raw message is kept to record the prompt cache usage
+        self.structured_output_llm = llm.with_structured_output(PydanticNotebookContent, include_raw=True)
         
         self.prompt_path = prompt_path
         self.treat_errors = treat_errors
@@ -367,14 +697,13 @@ class NotebookReaderAgent(FileInteractionAgent):
                 },
             ],
         )]
-        img_answer = self.vision_llm.invoke(messages).content
+        img_answer = self.record_response(self.vision_llm.invoke(messages)).content
         img_answer = f"\n[description of image with figure_id = {image_id}]\n prompt:{prompt}\n\nresult:\n{img_answer} \n[end of image description]\n"
 
         return img_answer 
 
     def get_context_from_file(self, specific_prompt: str, file_path: str, state: State) -> str:
         main_prompt = state.get('main_prompt', 'there is no main prompt')
-        current_context = format_current_context(state)
         try:
             file_content = self.get_file_content(file_path)
             notebook_data = self.preprocess_notebook(file_content)
@@ -389,12 +718,13 @@ class NotebookReaderAgent(FileInteractionAgent):
 
         prompt_variables = {
             "main_prompt" : main_prompt,
-            "current_context" : current_context,
+            "datasources" : format_datasources(state),
+            "project_notes" : format_project_notes(state),
             "file_path": file_path,
             "specific_prompt" : specific_prompt,
             "notebook_content" : notebook_content,
         }
-        prompt = render_prompt(self.prompt_path, prompt_variables)
+        prompt = self.render_within_budget(self.prompt_path, prompt_variables, ["project_notes", "notebook_content"], state, file_path)
         
         try:
             result = self.generate_answer(prompt)
@@ -420,10 +750,10 @@ class NotebookReaderAgent(FileInteractionAgent):
         return relevant_notebook_content
     
     def generate_answer(self, prompt):
-        result = self.structured_output_llm.invoke(prompt)
+        result = self.record_structured_response(self.structured_output_llm.invoke(prompt))
         relevant_notebook_content = {}
         if result is None:
-            result = self.llm.invoke(prompt)
+            result = self.record_response(self.llm.invoke(prompt))
             result = json.loads(result.content)
             relevant_notebook_content["relevant_content"] = result["relevant_content"]
             relevant_notebook_content["image_questions"] = result["image_questions"]
@@ -464,27 +794,32 @@ class ImageReaderAgent(FileInteractionAgent):
         try:
             base64_image = image_to_base64(image_path)
 
-            prompt = f"""
-            Focus on the following question while analyzing the image:
-            {specific_prompt}
+            # the image goes right after the static instruction, since it doesn't change between questions
+            static_prompt = "Provide insights that are possible to extract from the image."
+            prompt = assemble_prompt([
+                ("question", f"""
             Also, provide helpful information that's on the image and can help with answering this broader question.:
             '{main_prompt}'
-
+            """),
+                ("round", f"""
             [[Current knowledge of the project]]
-            {{current_context}}
+            {current_context}
             [[End of current knowledge]]
 
-            Provide insights that are possible to extract from the image.
-            """
+            Focus on the following question while analyzing the image:
+            {specific_prompt}
+            """)
+            ])
 
             messages = [HumanMessage(
                 content=[
-                    {"type": "text", "text": prompt},
+                    {"type": "text", "text": static_prompt},
                     {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}},
+                    {"type": "text", "text": prompt},
                 ]
             )]
 
-            result = self.vision_llm.invoke(messages).content
+            result = self.record_response(self.vision_llm.invoke(messages)).content
             formatted_result = f"""
             Prompt: '{specific_prompt}'
             
@@ -512,7 +847,7 @@ class ImageReaderAgent(FileInteractionAgent):
             str: Generated insights from the image.
         """
         main_prompt = state.get('main_prompt', 'there is no main prompt')
-        current_context = format_current_context(state)
+        current_context = format_project_notes(state)
 
         try:
             image_description = self.get_image_description(file_path, specific_prompt, main_prompt, current_context)
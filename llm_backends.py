@@ -0,0 +1,223 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List
+
+class BackendState:
+    """
+    Load and health of a single backend, shared by the pools created from the same backends
+    (e.g. the plain and the structured output versions of the same host).
+
+    Attributes:
+        name (str): the name of the backend, used in the error messages
+        outstanding (int): the number of requests currently running on the backend
+        consecutive_failures (int): the number of failed requests since the last success
+        ejected_until (float): the time (time.monotonic) until which the backend is not used
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+
+    def is_healthy(self) -> bool:
+        return time.monotonic() >= self.ejected_until
+
+class LLMBackendPool:
+    """
+    Pool of equivalent chat models (e.g. the same Ollama model served by several hosts) that can be used anywhere
+    RFERag and the agents expect a language model.
+
+    Each request goes to the healthy backend with the least outstanding requests, and has a deadline. Failed requests
+    are retried with exponential backoff, and optionally a duplicate (hedged) request is sent to another backend when
+    the first one takes longer than hedge_delay, using the first answer that arrives.
+    Backends that fail max_failures times in a row are ejected from the pool for ejection_time seconds.
+
+    Example:
+        pool = LLMBackendPool([
+            ChatOllama(model="qwen2.5:14b", base_url="http://localhost:11434"),
+            ChatOllama(model="qwen2.5:14b", base_url=ollama_api_url)
+        ], timeout=120, hedge_delay=20)
+    """
+    def __init__(
+            self,
+            backends: List,
+            timeout: float = 120,
+            max_retries: int = 2,
+            backoff_base: float = 0.5,
+            backoff_max: float = 10,
+            hedge_delay: float = None,
+            max_failures: int = 3,
+            ejection_time: float = 30,
+            names: List[str] = None,
+            states: List[BackendState] = None,
+            executor: ThreadPoolExecutor = None,
+            lock: threading.Lock = None
+            ):
+        """
+        Args:
+            backends (List[BaseLanguageModel]): the equivalent chat models
+            timeout (float): the deadline of each attempt in seconds
+            max_retries (int): the number of times a failed request is retried
+            backoff_base (float): the wait before the first retry, doubled at each retry
+            backoff_max (float): the maximum wait between retries
+            hedge_delay (float): the time in seconds after which a duplicate request is sent to another backend, if None there are no hedged requests
+            max_failures (int): the number of consecutive failures after which a backend is ejected
+            ejection_time (float): the time in seconds that an ejected backend stays out of the pool
+            names (List[str]): the names of the backends, used in the error messages
+            states, executor, lock: shared with the pool created by with_structured_output, not meant to be passed directly
+        """
+        if len(backends) == 0:
+            raise ValueError("The pool needs at least one backend")
+        self.backends = backends
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_delay = hedge_delay
+        self.max_failures = max_failures
+        self.ejection_time = ejection_time
+
+        if names is None:
+            names = [getattr(backend, "base_url", None) or f"backend_{i}" for i, backend in enumerate(backends)]
+        self.states = states if states is not None else [BackendState(name) for name in names]
+        # the calls run in threads, so the deadline can be enforced even if the backend doesn't support timeouts
+        self.executor = executor if executor is not None else ThreadPoolExecutor(max_workers=8 * len(backends))
+        self.lock = lock if lock is not None else threading.Lock()
+
+    def choose_backend(self, exclude: List[int] = []) -> int:
+        """
+        Returns the index of the healthy backend with the least outstanding requests.
+        If all the backends are ejected, the one that will come back first is used.
+        """
+        with self.lock:
+            candidates = [i for i in range(len(self.backends)) if i not in exclude]
+            if len(candidates) == 0:
+                return None
+            healthy = [i for i in candidates if self.states[i].is_healthy()]
+            if len(healthy) == 0:
+                return min(candidates, key=lambda i: self.states[i].ejected_until)
+            least_outstanding = min(self.states[i].outstanding for i in healthy)
+            return random.choice([i for i in healthy if self.states[i].outstanding == least_outstanding])
+
+    @staticmethod
+    def claim_health_update(request: dict) -> bool:
+        """
+        Returns True only the first time the health of the backend is updated for the request, so a request that
+        timed out (and was already counted as a failure) is not counted again when it finishes. Called with the lock.
+        """
+        if request is None:
+            return True
+        if request["health_recorded"]:
+            return False
+        request["health_recorded"] = True
+        return True
+
+    def record_failure(self, index: int, request: dict = None) -> None:
+        with self.lock:
+            if not self.claim_health_update(request):
+                return
+            state = self.states[index]
+            state.consecutive_failures += 1
+            if state.consecutive_failures >= self.max_failures:
+                print(f"Ejecting the backend '{state.name}' after {state.consecutive_failures} consecutive failures")
+                state.ejected_until = time.monotonic() + self.ejection_time
+
+    def record_success(self, index: int, request: dict = None) -> None:
+        with self.lock:
+            if not self.claim_health_update(request):
+                return
+            self.states[index].consecutive_failures = 0
+            self.states[index].ejected_until = 0.0
+
+    def call_backend(self, index: int, request: dict, input, args, kwargs):
+        try:
+            result = self.backends[index].invoke(input, *args, **kwargs)
+        except Exception:
+            self.record_failure(index, request)
+            raise
+        finally:
+            with self.lock:
+                self.states[index].outstanding -= 1
+        self.record_success(index, request)
+        return result
+
+    def submit(self, index: int, input, args, kwargs):
+        """
+        Sends the request to the backend, returning its future and the request, whose health update is done only once.
+        """
+        request = {"health_recorded": False}
+        with self.lock:
+            self.states[index].outstanding += 1
+        return self.executor.submit(self.call_backend, index, request, input, args, kwargs), request
+
+    def attempt(self, input, args, kwargs):
+        """
+        Makes a single attempt, with an optional hedged request, within the deadline.
+        """
+        deadline = time.monotonic() + self.timeout
+        primary = self.choose_backend()
+        future, request = self.submit(primary, input, args, kwargs)
+        futures = {future: (primary, request)}
+
+        if self.hedge_delay is not None and self.hedge_delay < self.timeout:
+            done, _ = wait(futures.keys(), timeout=self.hedge_delay)
+            if len(done) == 0:
+                hedge = self.choose_backend(exclude=[primary])
+                if hedge is not None and self.states[hedge].is_healthy():
+                    future, request = self.submit(hedge, input, args, kwargs)
+                    futures[future] = (hedge, request)
+
+        not_done = set(futures.keys())
+        first_error = None
+        while len(not_done) > 0:
+            done, not_done = wait(not_done, timeout=max(deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+            if len(done) == 0:
+                break
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                if first_error is None:
+                    first_error = future.exception()
+
+        if first_error is not None and len(not_done) == 0:
+            raise first_error
+        # the requests still running count as failures, they keep their outstanding count until they finish,
+        # and their late results don't update the health of the backend again
+        for future in not_done:
+            self.record_failure(*futures[future])
+        names = ", ".join(self.states[futures[future][0]].name for future in not_done)
+        raise TimeoutError(f"The request to the backends {names} exceeded the deadline of {self.timeout} seconds")
+
+    def invoke(self, input, *args, **kwargs):
+        last_error = None
+        for retry in range(self.max_retries + 1):
+            if retry > 0:
+                # exponential backoff with jitter
+                backoff = min(self.backoff_max, self.backoff_base * 2 ** (retry - 1))
+                time.sleep(backoff * random.uniform(0.5, 1.0))
+            try:
+                return self.attempt(input, args, kwargs)
+            except Exception as e:
+                print(f"Error with the backend pool (attempt {retry + 1} of {self.max_retries + 1}): {e}")
+                last_error = e
+        raise last_error
+
+    def with_structured_output(self, schema, **kwargs) -> "LLMBackendPool":
+        """
+        Returns a pool of the structured output versions of the backends, sharing the load and health of this pool.
+        """
+        return LLMBackendPool(
+            [backend.with_structured_output(schema, **kwargs) for backend in self.backends],
+            timeout=self.timeout,
+            max_retries=self.max_retries,
+            backoff_base=self.backoff_base,
+            backoff_max=self.backoff_max,
+            hedge_delay=self.hedge_delay,
+            max_failures=self.max_failures,
+            ejection_time=self.ejection_time,
+            states=self.states,
+            executor=self.executor,
+            lock=self.lock
+        )
@@ -0,0 +1,136 @@
+import os
+from typing import Dict, List, Tuple
+
+class RoutedLLM:
+    """
+    Chat model that tries a chain of models in order, escalating to the next one when a call fails.
+    It can be used anywhere RFERag and the agents expect a language model.
+    """
+    def __init__(self, llms: List, route: List[str] = None):
+        """
+        Args:
+            llms (List[BaseLanguageModel]): the models, from the first to be tried to the last fallback
+            route (List[str]): the names of the tiers of the models, used in the error messages
+        """
+        if len(llms) == 0:
+            raise ValueError("A routed model needs at least one model")
+        self.llms = llms
+        self.route = route if route is not None else [str(i) for i in range(len(llms))]
+
+    def invoke(self, input, *args, **kwargs):
+        last_error = None
+        for tier, llm in zip(self.route, self.llms):
+            try:
+                return llm.invoke(input, *args, **kwargs)
+            except Exception as e:
+                print(f"Error with the model of the tier '{tier}', escalating: {e}")
+                last_error = e
+        raise last_error
+
+    def with_structured_output(self, schema, **kwargs) -> "RoutedStructuredLLM":
+        return RoutedStructuredLLM([llm.with_structured_output(schema, **kwargs) for llm in self.llms], self.route)
+
+class RoutedStructuredLLM:
+    """
+    Structured output version of RoutedLLM, it also escalates when a model fails to return the structured output (returns None,
+    or a result without the parsed output when created with include_raw=True).
+    If every model fails to return it, the last empty result is returned, so the callers can still use their own fallbacks.
+    """
+    def __init__(self, llms: List, route: List[str]):
+        self.llms = llms
+        self.route = route
+
+    def invoke(self, input, *args, **kwargs):
+        last_error = None
+        got_empty_answer = False
+        empty_result = None
+        for tier, llm in zip(self.route, self.llms):
+            try:
+                result = llm.invoke(input, *args, **kwargs)
+            except Exception as e:
+                print(f"Error with the structured output of the tier '{tier}', escalating: {e}")
+                last_error = e
+                continue
+            if result is not None and not (isinstance(result, dict) and "parsed" in result and result["parsed"] is None):
+                return result
+            got_empty_answer = True
+            empty_result = result
+        if got_empty_answer:
+            return empty_result
+        raise last_error
+
+class ModelRouter:
+    """
+    Maps each graph node and agent type (the roles) to a route of model tiers, e.g. a small local model for the
+    extraction of the text files and a stronger model for the final answer.
+    Each route is a list of tiers, the first one is used and the next ones are fallbacks in case of errors.
+
+    The roles are the graph nodes "context_evaluation", "update_context" and "give_final_answer", and the agent types
+    "text", "data", "image" and "notebook". The agent routes can also be specialized by the size class of the file,
+    using "<agent type>:<size class>" as the role, e.g. "text:large".
+
+    Example:
+        router = ModelRouter(
+            tiers={
+                "small": (llama3, llama3_structured),
+                "strong": (gpt, gpt)
+            },
+            routes={
+                "text": ["small", "strong"],
+                "text:large": ["strong"],
+                "give_final_answer": ["strong"]
+            },
+            default_route=["small", "strong"]
+        )
+    """
+    def __init__(
+            self,
+            tiers: Dict[str, Tuple],
+            routes: Dict[str, List[str]],
+            default_route: List[str] = None,
+            size_classes: Dict[str, int] = None
+            ):
+        """
+        Args:
+            tiers (Dict[str, Tuple]): maps the tier names to a tuple (llm, structured_llm)
+            routes (Dict[str, List[str]]): maps the roles to the list of tiers to be tried
+            default_route (List[str]): the route of the roles without a route, by default all the tiers in order
+            size_classes (Dict[str, int]): maps the size classes to the maximum file size in bytes, the files
+                bigger than all of them are in the "large" class. By default "small" is up to 20KB and "medium" up to 200KB.
+        """
+        for route in list(routes.values()) + [default_route or []]:
+            for tier in route:
+                if tier not in tiers:
+                    raise ValueError(f"Unknown model tier: {tier}")
+        self.tiers = tiers
+        self.routes = routes
+        self.default_route = default_route if default_route is not None else list(tiers.keys())
+        if size_classes is None:
+            size_classes = {"small": 20 * 1024, "medium": 200 * 1024}
+        self.size_classes = sorted(size_classes.items(), key=lambda item: item[1])
+
+    def get_size_class(self, file_path: str) -> str:
+        try:
+            file_size = os.path.getsize(file_path)
+        except OSError:
+            return None
+        for size_class, max_size in self.size_classes:
+            if file_size <= max_size:
+                return size_class
+        return "large"
+
+    def has_size_routes(self, role: str) -> bool:
+        return any(key.startswith(role + ":") for key in self.routes)
+
+    def get_route(self, role: str, size_class: str = None) -> List[str]:
+        if size_class is not None and f"{role}:{size_class}" in self.routes:
+            return self.routes[f"{role}:{size_class}"]
+        return self.routes.get(role, self.default_route)
+
+    def get_llm(self, role: str, size_class: str = None) -> RoutedLLM:
+        route = self.get_route(role, size_class)
+        return RoutedLLM([self.tiers[tier][0] for tier in route], route)
+
+    def get_structured_llm(self, role: str, size_class: str = None) -> RoutedLLM:
+        route = self.get_route(role, size_class)
+        return RoutedLLM([self.tiers[tier][1] for tier in route], route)
@@ -0,0 +1,97 @@
+import threading
+from typing import Dict, List, Tuple
+
+import jinja2
+
+# The prompts are assembled from the segment that changes the least to the one that changes the most, so consecutive
+# calls share the longest possible prefix and the backends can reuse it (Ollama KV cache, provider prompt caching):
+#   static: instructions and answer format, the same for every call of the prompt
+#   datasource: datasources listing and file contents, the same while the datasources don't change
+#   question: the user prompt, the same for every call while answering it
+#   round: the notes of the current exploration round and the specific prompts
+PROMPT_SEGMENTS = ["static", "datasource", "question", "round"]
+
+def assemble_prompt(segments: List[Tuple[str, str]]) -> str:
+    """
+    Joins the segments of a prompt ordered by their level (see PROMPT_SEGMENTS), keeping the relative order of
+    the segments of the same level.
+
+    Args:
+        segments (List[Tuple[str, str]]): a list of tuples with the segment level and text
+
+    Returns:
+        str: the assembled prompt
+    """
+    for level, _ in segments:
+        if level not in PROMPT_SEGMENTS:
+            raise ValueError(f"Unknown prompt segment: {level}")
+    ordered = sorted(segments, key=lambda segment: PROMPT_SEGMENTS.index(segment[0]))
+    return "\n\n".join(text.strip("\n") for _, text in ordered)
+
+def is_segmented_template(template: jinja2.Template) -> bool:
+    return any(block in PROMPT_SEGMENTS for block in template.blocks)
+
+def render_segmented_template(template: jinja2.Template, prompt_variables: dict) -> str:
+    """
+    Renders the blocks of the template named after the prompt segments (e.g. {% block static %}),
+    in the order of PROMPT_SEGMENTS regardless of their position in the template file.
+    """
+    context = template.new_context(prompt_variables)
+    segments = [
+        (level, "".join(template.blocks[level](context)))
+        for level in PROMPT_SEGMENTS if level in template.blocks
+    ]
+    return assemble_prompt(segments)
+
+class PromptCacheMetrics:
+    """
+    Aggregates the prompt cache usage reported by the backends in the responses of the language models.
+
+    The langchain models report the cached input tokens in usage_metadata["input_token_details"]["cache_read"]
+    (OpenAI and Anthropic prompt caching), and Ollama reports the number and duration of the evaluated prompt
+    tokens, which drop when the KV cache of the previous call is reused.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        self.calls = 0
+        self.input_tokens = 0
+        self.cache_read_tokens = 0
+        self.cache_hits = 0
+        self.prompt_eval_duration = 0
+
+    def record(self, response) -> None:
+        usage = getattr(response, "usage_metadata", None) or {}
+        metadata = getattr(response, "response_metadata", None) or {}
+        cache_read = (usage.get("input_token_details") or {}).get("cache_read", 0) or 0
+        with self.lock:
+            self.calls += 1
+            self.input_tokens += usage.get("input_tokens", 0) or 0
+            self.cache_read_tokens += cache_read
+            if cache_read > 0:
+                self.cache_hits += 1
+            self.prompt_eval_duration += metadata.get("prompt_eval_duration", 0) or 0
+
+    def record_structured(self, result):
+        """
+        Records the raw message of a structured output invoked with include_raw=True, and returns the parsed output
+        (None if the model response could not be parsed).
+        """
+        if result is None:
+            return None
+        self.record(result["raw"])
+        return result["parsed"]
+
+    def summary(self) -> Dict[str, float]:
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "input_tokens": self.input_tokens,
+                "cache_read_tokens": self.cache_read_tokens,
+                "cache_hit_calls": self.cache_hits,
+                "cache_hit_rate": self.cache_read_tokens / self.input_tokens if self.input_tokens > 0 else 0.0,
+                # reported by ollama, in nanoseconds
+                "prompt_eval_duration": self.prompt_eval_duration
+            }
@@ -1,10 +1,23 @@
 import os
 from pydantic import BaseModel, Field
-from typing import Dict, Optional, Literal
-from utils import State, display_app_graph, format_current_context, render_prompt, list_avaliable_relative_files, get_exploration_queue
+from typing import Dict, List, Optional, Literal
+from utils import State, display_app_graph, format_current_context, format_datasources, format_project_notes, render_prompt, list_avaliable_relative_files, get_exploration_queue
+from prompt_assembly import assemble_prompt, PromptCacheMetrics
 from langgraph.graph import StateGraph, MessagesState, START, END
 from file_interaction import FileInteractionAgent, DataReaderAgent, TextReaderAgent, ImageReaderAgent, NotebookReaderAgent
+from answer_cache import AnswerCache, datasources_fingerprint
+from model_routing import ModelRouter
+from table_statistics import StatisticsStore
+from sql_tools import SQLPlanCache
+from token_budget import TokenBudget, record_token_report
+from checkpoints import CheckpointStore, END_NODE
+from exploration_workers import ExplorationQueue, InProcessExplorationQueue
+from exploration_control import ExplorationController
 import json
+import time
+import threading
+import uuid
+from concurrent.futures import Future, wait, FIRST_COMPLETED
 
 
 class PydanticExploration(BaseModel):
@@ -36,6 +49,10 @@ class PydanticExploration(BaseModel):
             The inner dictionaries map file paths to their respective exploration prompts.
             
         give_final_answer (bool): A flag indicating whether the final answer should be given without further exploration.
+
+        confidence (float): From 0 to 1, how confident the model is that the current context answers the prompt.
+
+        coverage (float): From 0 to 1, the fraction of the necessary information already in the current context.
     """
     explore: Optional[Dict[str, Dict[str, str]]] = Field(
         default_factory=dict,
@@ -45,6 +62,33 @@ class PydanticExploration(BaseModel):
         default=False,
         description="A flag indicating whether the final answer should be given without further exploration."
     )
+    confidence: Optional[float] = Field(
+        default=None,
+        description="From 0 to 1, how confident you are that the current understanding of the project answers the prompt."
+    )
+    coverage: Optional[float] = Field(
+        default=None,
+        description="From 0 to 1, the fraction of the information necessary to answer the prompt that is already in the current understanding of the project."
+    )
+
+class PydanticBatchAnswer(BaseModel):
+    """
+    Structures the final answers of a batch of questions, answered from the same accumulated context.
+
+    Example structure:
+
+            {
+                "answers": {
+                    "1": "answer to the first question",
+                    "2": "answer to the second question",
+                    ...
+                }
+            }
+    """
+    answers: Dict[str, str] = Field(
+        default_factory=dict,
+        description="A dictionary where the keys are the numbers of the questions and the values are their answers."
+    )
 
 class RFERag:
     """
@@ -68,8 +112,13 @@ class RFERag:
             Updates the context with the new information acquired from the exploration.
         give_answer_node(state: State) -> State:
             Provides the final answer to the user based on the accumulated context.
+        answer_batch(prompts: List[str]) -> List[Dict[str, str]]:
+            Answers several questions sharing a single exploration of the datasources.
+
+    The instance can answer concurrent requests (see serving.py): the agents, templates and caches are shared,
+    while each request has its own state, with a copy of the datasources.
     """
-    
+
     def __init__(   
             self,
             llm: BaseModel,
@@ -77,7 +126,15 @@ class RFERag:
             prompts_folder: str,
             datasources_paths: list = [],
             max_exploration_counter: int = 3,
-            max_explorations: int = 15
+            max_explorations: int = 15,
+            max_parallel_explorations: int = 4,
+            exploration_deadline: float = None,
+            answer_cache: AnswerCache = None,
+            router: ModelRouter = None,
+            token_budget: TokenBudget = None,
+            checkpoint_store: CheckpointStore = None,
+            task_queue: ExplorationQueue = None,
+            controller: ExplorationController = None
             ) -> None:
         """
         Initializes the recursive file exploration class.
@@ -85,6 +142,22 @@ class RFERag:
             llm: The language model to be used for text processing.
             structured_llm: The structured language model to be used for data processing.
             prompts_folder: The folder containing prompt templates.
+            max_parallel_explorations: The number of files explored at the same time.
+            exploration_deadline: The maximum time in seconds that an exploration round waits for the files, the files
+                that are not finished by then are attached in the next round. If None, the round waits for all the files.
+            answer_cache: Cache of the final answers, checked before running the graph. If None, the answers are not cached.
+            router: Maps each node and agent type (and file size class) to a route of model tiers. If None, llm and
+                structured_llm are used everywhere.
+            token_budget: Keeps the prompts within the context window, trimming the lowest priority sections. If None,
+                a budget is created for the context window of the model of each node and agent type, when it is known
+                (e.g. num_ctx is set for ChatOllama), otherwise the prompts are only counted, not trimmed.
+            checkpoint_store: Saves the state after each node, so interrupted runs can be resumed with their run id.
+                If None, the runs are not saved.
+            task_queue: Where the explorations of the files are sent, e.g. a pool of worker processes or hosts
+                (see exploration_workers.py). If None, the files are explored in max_parallel_explorations threads.
+            controller: Stops the exploration before max_exploration_counter and max_explorations when more rounds
+                are unlikely to change the answer, or when the question is out of its latency or token budget.
+                If None, an ExplorationController with the default thresholds and without budgets is used.
         Attributes:
             llm: The language model instance.
             structured_llm: The structured language model instance.
@@ -96,39 +169,47 @@ class RFERag:
         """
         self.llm = llm
         self.structured_llm = structured_llm
+        self.router = router
+        self.token_budget = token_budget
+        self.prompt_cache_metrics = PromptCacheMetrics()
 
         self.prompts_folder = os.path.abspath(prompts_folder).replace("\\", "/") + "/"
         self.datasources = {}
+        self.datasources_lock = threading.Lock()
         for path in datasources_paths:
             self.add_datasource(path)
 
         self.max_exploration_counter = max_exploration_counter
         self.max_explorations = max_explorations
+        self.exploration_deadline = exploration_deadline
+        self.task_queue = task_queue if task_queue is not None else InProcessExplorationQueue(self.explore_file, max_parallel_explorations)
+        self.answer_cache = answer_cache
+        self.checkpoint_store = checkpoint_store
+        self.controller = controller if controller is not None else ExplorationController()
 
         self.workflow = StateGraph(State)
 
         # Define the nodes
-        self.workflow.add_node("context_evaluation", self.context_evaluation_node)
-        self.workflow.add_node("exploration", self.exploration_node)
-        self.workflow.add_node("update_context", self.update_context_node)
-        self.workflow.add_node("give_final_answer", self.give_answer_node)
+        self.workflow.add_node("context_evaluation", self.checkpointed("context_evaluation", self.context_evaluation_node))
+        self.workflow.add_node("exploration", self.checkpointed("exploration", self.exploration_node))
+        self.workflow.add_node("update_context", self.checkpointed("update_context", self.update_context_node))
+        self.workflow.add_node("give_final_answer", self.checkpointed("give_final_answer", self.give_answer_node))
 
         # Define the edges
-        self.workflow.add_edge(START, "context_evaluation")
-
-        def decide_next_node(state: State) -> Literal["Files to explore", "Sufficient context", "Max explorations"]:
-            if state["exploration_queue"] == []:
-                return "Sufficient context"
-            if state["exploration_counter"] >= self.max_exploration_counter:
-                return "Max explorations"
-            if state["num_explorations"] >= self.max_explorations:
-                return "Max explorations"
-            return "Files to explore"
-        self.workflow.add_conditional_edges("context_evaluation", decide_next_node, path_map={
+        # resumed runs start at the node after their last checkpoint
+        self.workflow.add_conditional_edges(
+            START,
+            lambda state: state.get("resume_node") or "context_evaluation",
+            path_map=["context_evaluation", "exploration", "update_context", "give_final_answer"]
+        )
+
+        self.evaluation_path_map = {
             "Files to explore": "exploration",
             "Sufficient context": "give_final_answer",
+            "Adaptive stop": "give_final_answer",
             "Max explorations": "give_final_answer"
-        })
+        }
+        self.workflow.add_conditional_edges("context_evaluation", self.decide_next_node, path_map=self.evaluation_path_map)
 
         self.workflow.add_edge("exploration", "update_context")
         self.workflow.add_edge("update_context", "context_evaluation")
@@ -144,19 +225,123 @@ class RFERag:
             "notebook": ["ipynb"]
         }
 
+        # shared by all the data agents, including the ones routed by file size
+        self.statistics_store = StatisticsStore()
+        self.plan_cache = SQLPlanCache()
+
         self.context_agents_map = {
-            "text": TextReaderAgent(self.llm, self.prompts_folder + "context_from_text_file.jinja2"),
-            "data": DataReaderAgent(self.structured_llm, self.prompts_folder + "context_from_dataframe.jinja2"),
-            "image": ImageReaderAgent(self.llm),
-            "notebook": NotebookReaderAgent(self.llm, self.prompts_folder + "context_from_notebook_file.jinja2")
+            context_type: self.create_agent(context_type) for context_type in self.file_extension_map
         }
+        # agents of the size classes with their own model routes, created when needed
+        self.sized_agents = {}
+        self.sized_agents_lock = threading.Lock()
+
+        # the state of the last node is kept per thread, so concurrent requests don't overwrite each other
+        self.request_local = threading.local()
+
+    @property
+    def last_state(self) -> State:
+        return getattr(self.request_local, "last_state", None)
+
+    @last_state.setter
+    def last_state(self, state: State) -> None:
+        self.request_local.last_state = state
+
+    def decide_next_node(self, state: State) -> Literal["Files to explore", "Sufficient context", "Adaptive stop", "Max explorations"]:
+        # the files that missed the deadline of the last round are collected before the final answer
+        if state["exploration_queue"] == []:
+            return "Sufficient context"
+        # decided by the controller in the context evaluation
+        if state.get("stop_reason"):
+            return "Adaptive stop"
+        if state["exploration_counter"] >= self.max_exploration_counter:
+            return "Max explorations"
+        if state["num_explorations"] >= self.max_explorations:
+            return "Max explorations"
+        return "Files to explore"
+
+    def get_next_node(self, node: str, state: State) -> str:
+        if node == "context_evaluation":
+            return self.evaluation_path_map[self.decide_next_node(state)]
+        if node == "exploration":
+            return "update_context"
+        if node == "update_context":
+            return "context_evaluation"
+        return END_NODE
+
+    def checkpointed(self, node: str, node_function):
+        """
+        Wraps a node of the graph to save the state in the checkpoint store after the node completes.
+        """
+        def run_node(state: State) -> State:
+            result = node_function(state)
+            run_id = state.get("run_id")
+            if self.checkpoint_store is not None and run_id is not None:
+                new_state = {**state, **result}
+                self.checkpoint_store.save(run_id, node, self.get_next_node(node, new_state), new_state)
+            return result
+        return run_node
+
+    def get_llm(self, role: str, structured: bool = False, size_class: str = None) -> BaseModel:
+        """
+        Returns the language model for a node or agent type, given by the router if there is one.
+        """
+        if self.router is None:
+            return self.structured_llm if structured else self.llm
+        if structured:
+            return self.router.get_structured_llm(role, size_class)
+        return self.router.get_llm(role, size_class)
 
-        self.last_state = None
+    def get_token_budget(self, role: str, size_class: str = None) -> TokenBudget:
+        """
+        Returns the token budget for a node or agent type, for the context window of its model if no budget was given.
+        """
+        if self.token_budget is not None:
+            return self.token_budget
+        return TokenBudget.for_model(self.get_llm(role, size_class=size_class))
+
+    def fit_prompt(self, state: State, role: str, render, prompt_variables: dict, trimmable: List[str]) -> str:
+        """
+        Renders the prompt of a node within its token budget, adding the token counts to the answer trace.
+        """
+        prompt, report = self.get_token_budget(role).fit(render, prompt_variables, trimmable, name=role)
+        record_token_report(state, report)
+        return prompt
+
+    def create_agent(self, context_type: str, size_class: str = None) -> FileInteractionAgent:
+        agent = self.build_agent(context_type, size_class)
+        agent.prompt_cache_metrics = self.prompt_cache_metrics
+        agent.token_budget = self.get_token_budget(context_type, size_class)
+        return agent
+
+    def build_agent(self, context_type: str, size_class: str = None) -> FileInteractionAgent:
+        if context_type == "text":
+            return TextReaderAgent(self.get_llm("text", size_class=size_class), self.prompts_folder + "context_from_text_file.jinja2")
+        if context_type == "data":
+            return DataReaderAgent(
+                self.get_llm("data", structured=True, size_class=size_class),
+                self.prompts_folder + "context_from_dataframe.jinja2",
+                repair_prompt_path=self.prompts_folder + "repair_sql_query.jinja2",
+                statistics_store=self.statistics_store,
+                plan_cache=self.plan_cache
+            )
+        if context_type == "image":
+            return ImageReaderAgent(self.get_llm("image", size_class=size_class))
+        if context_type == "notebook":
+            return NotebookReaderAgent(self.get_llm("notebook", size_class=size_class), self.prompts_folder + "context_from_notebook_file.jinja2")
+        raise ValueError(f"Unknown context type: {context_type}")
 
     def get_agent(self, file_path: str) -> FileInteractionAgent:
         file_extension = file_path.split(".")[-1]
         for context_type, extensions in self.file_extension_map.items():
             if file_extension in extensions:
+                if self.router is not None and self.router.has_size_routes(context_type):
+                    size_class = self.router.get_size_class(file_path)
+                    if f"{context_type}:{size_class}" in self.router.routes:
+                        with self.sized_agents_lock:
+                            if (context_type, size_class) not in self.sized_agents:
+                                self.sized_agents[(context_type, size_class)] = self.create_agent(context_type, size_class)
+                            return self.sized_agents[(context_type, size_class)]
                 return self.context_agents_map[context_type]
         return None
 
@@ -176,28 +361,42 @@ class RFERag:
             return {}
         
         prompt_file = self.prompts_folder + "exploration_prompt.jinja2"
-        current_context = format_current_context(state)
         main_prompt = state["main_prompt"]
         example_datasource_path = list(state["datasources"].keys())[0]
         
-        prompt = render_prompt(prompt_file, {
-            "current_context": current_context,
+        prompt = self.fit_prompt(state, "context_evaluation", lambda variables: render_prompt(prompt_file, variables), {
+            "datasources": format_datasources(state),
+            "project_notes": format_project_notes(state),
             "main_prompt": main_prompt,
             "example_datasource_path": example_datasource_path
-        })
+        }, ["project_notes"])
 
         try:
-            answer = self.structured_llm.with_structured_output(PydanticExploration).invoke(prompt)
+            structured_llm = self.get_llm("context_evaluation", structured=True)
+            answer = self.prompt_cache_metrics.record_structured(
+                structured_llm.with_structured_output(PydanticExploration, include_raw=True).invoke(prompt)
+            )
             if answer is None:
                 # Some models have a problem with the structured output, I'm not sure why
-                answer = self.structured_llm.invoke(prompt)
+                answer = structured_llm.invoke(prompt)
+                self.prompt_cache_metrics.record(answer)
                 answer = json.loads(answer.content)
                 explore = answer.get("explore", {})
                 give_final_answer = answer.get("give_final_answer", False)
+                confidence = answer.get("confidence")
+                coverage = answer.get("coverage")
             else:
                 explore = answer.explore
                 give_final_answer = answer.give_final_answer
-                
+                confidence = answer.confidence
+                coverage = answer.coverage
+
+            self.controller.record_round(state, confidence, coverage)
+            stop_reason = self.controller.get_stop_reason(state)
+            if stop_reason is not None and not give_final_answer:
+                print(f"Stopping the exploration: {stop_reason}")
+                state["stop_reason"] = stop_reason
+
             if give_final_answer:
                 state["exploration_queue"] = []
                 return state
@@ -211,53 +410,130 @@ class RFERag:
             state["exploration_queue"] = []
             return state
 
+    def explore_file(self, file_path: str, specific_prompt: str, state: State) -> str:
+        """
+        Explores a single file with the agent for its extension and returns the generated context.
+        This method runs in the exploration threads, so it receives a copy of the state.
+        """
+        agent = self.get_agent(file_path)
+        if agent is None:
+            return "Cannot explore this file, the file extension is not supported"
+        generated_context = agent.get_context_from_file(specific_prompt=specific_prompt, file_path=file_path, state=state)
+        return "Prompt: " + specific_prompt + "\n" + generated_context
+
+    def collect_exploration(self, state: State, file_path: str, specific_prompt: str, future: Future) -> tuple:
+        """
+        Gets the context generated by a finished exploration and updates the exploration counters of the state.
+        """
+        try:
+            generated_context = future.result()
+        except Exception as e:
+            generated_context = "Prompt: " + specific_prompt + "\n" + f"An error occured while exploring the file: {str(e)}"
+
+        explored_files = state.get("explored_files", [])
+        # caso o arquivo já tivesse sido explorado, adicionar o aviso
+        # de que o arquivo já foi explorado
+        if file_path in explored_files:
+            generated_context += "\nThis file has already been explored - Important: You should stop exploring the same files again!"
+        else:
+            explored_files.append(file_path)
+
+        state["num_explorations"] = state["num_explorations"] + 1
+        state["explored_files"] = explored_files
+        return (file_path, generated_context)
+
     def exploration_node(self, state: State) -> State:
         """
         This node is responsible for exploring the files and returning the new context.
+
+        The files are explored in parallel, and the notes of the finished files are folded into the context
+        while the other files are still being explored, so the update of the context is pipelined with the exploration.
+        The files that are not finished before the exploration deadline are left pending, and their notes are attached
+        in the next round, or before the final answer.
         """
         self.last_state = state
         
-        state["exploration_counter"] = state["exploration_counter"] + 1
         exploration_queue = state["exploration_queue"]
-        if exploration_queue == []:
-            return state
-        
-        aquired_context = []
-        for exploration in exploration_queue:
-            file_path, specific_prompt = exploration
-            agent = self.get_agent(file_path)
-            if agent is None:
-                aquired_context.append((file_path, "Cannot explore this file, the file extension is not supported"))
+
+        # the explorations receive a copy of the state, since the context is updated while they run
+        state_snapshot = State(**state)
+
+        futures = self.get_pending_futures(state, state_snapshot)
+        pending_explorations = set(futures.values())
+        submitted = 0
+        for file_path, specific_prompt in exploration_queue:
+            if (file_path, specific_prompt) in pending_explorations:
                 continue
-            explored_files = state.get("explored_files", [])
-
-            generated_context = agent.get_context_from_file(specific_prompt=specific_prompt, file_path=file_path, state=state)
-            generated_context = "Prompt: " + specific_prompt + "\n" + generated_context
-            # caso o arquivo já tivesse sido explorado, adicionar o aviso
-            # de que o arquivo já foi explorado
-            if file_path in explored_files:
-                generated_context += "\nThis file has already been explored - Important: You should stop exploring the same files again!"
-            else:
-                explored_files.append(file_path)
+            future = self.task_queue.submit(file_path, specific_prompt, state_snapshot)
+            futures[future] = (file_path, specific_prompt)
+            submitted += 1
 
-            aquired_context.append((file_path, generated_context))
+        # the rounds that only wait for the stragglers are not counted
+        if submitted > 0:
+            state["exploration_counter"] = state["exploration_counter"] + 1
 
-            state["num_explorations"] = state["num_explorations"] + 1
-            state["explored_files"] = explored_files
+        if len(futures) == 0:
+            state["exploration_queue"] = []
+            return state
 
+        deadline = None if self.exploration_deadline is None else time.monotonic() + self.exploration_deadline
+        aquired_context = []
+        not_done = set(futures.keys())
+        while len(not_done) > 0:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            done, not_done = wait(not_done, timeout=timeout, return_when=FIRST_COMPLETED)
+            if len(done) == 0:
+                # deadline reached
+                break
+            for future in done:
+                file_path, specific_prompt = futures[future]
+                aquired_context.append(self.collect_exploration(state, file_path, specific_prompt, future))
+            if len(not_done) > 0:
+                # fold the finished notes into the context while the other files are being explored
+                self.fold_context(state, aquired_context)
+                aquired_context = []
+
+        # the stragglers have no notes yet, so they are not folded into the context
+        state["pending_explorations"] = [(*futures[future], future) for future in not_done]
+
+        # the remaining notes are folded in the update context node
         state["exploration_queue"] = aquired_context
 
         return state
 
-    def update_context_node(self, state: State) -> State:
+    def get_pending_futures(self, state: State, state_snapshot: State) -> Dict[Future, tuple]:
         """
-        This node is responsible for updating the context with the new information aquired from the exploration.
+        Returns the futures of the stragglers of the previous round, they are not submitted again
+        unless the run was resumed from a checkpoint, where their futures were lost.
+        """
+        futures = {}
+        for file_path, specific_prompt, future in state.get("pending_explorations", []):
+            if future is None:
+                future = self.task_queue.submit(file_path, specific_prompt, state_snapshot)
+            futures[future] = (file_path, specific_prompt)
+        return futures
+
+    def collect_pending_explorations(self, state: State) -> None:
+        """
+        Waits once for the stragglers, at most the exploration deadline, and folds their notes into the context
+        before the final answer. The ones that are still not finished are discarded.
+        """
+        if state.get("pending_explorations", []) == []:
+            return
+        futures = self.get_pending_futures(state, State(**state))
+        done, not_done = wait(futures.keys(), timeout=self.exploration_deadline)
+        aquired_context = [self.collect_exploration(state, *futures[future], future) for future in done]
+        for future in not_done:
+            print(f"The exploration of {futures[future][0]} was not finished before the final answer, its notes are discarded")
+        state["pending_explorations"] = []
+        self.fold_context(state, aquired_context)
+
+    def fold_context(self, state: State, aquired_context: list) -> None:
+        """
+        Updates the dynamic context of the state with the notes aquired from the explored files.
         """
-        self.last_state = state
-        
-        aquired_context = state["exploration_queue"]
         if aquired_context == []:
-            return state
+            return
 
         incoming_context = "This is the context aquired from the exploration:\n\n"
         for relevant_content in aquired_context:
@@ -269,17 +545,32 @@ class RFERag:
             """
 
         main_prompt = state["main_prompt"]
-        project_structure = state["datasources"]
+        project_structure = str(state["datasources"])
         current_context = state["dynamic_context"]
 
-        prompt = render_prompt(self.prompts_folder + "update_internal_context.jinja2", {
+        prompt_file = self.prompts_folder + "update_internal_context.jinja2"
+        prompt = self.fit_prompt(state, "update_context", lambda variables: render_prompt(prompt_file, variables), {
             "main_prompt": main_prompt,
             "project_structure": project_structure,
             "current_context": current_context,
             "incoming_context": incoming_context
-        })
-        new_context = self.llm.invoke(prompt).content.strip()
+        }, ["current_context", "incoming_context"])
+        response = self.get_llm("update_context").invoke(prompt)
+        self.prompt_cache_metrics.record(response)
+        new_context = response.content.strip()
         state["dynamic_context"] = new_context
+
+    def update_context_node(self, state: State) -> State:
+        """
+        This node is responsible for updating the context with the new information aquired from the exploration.
+        """
+        self.last_state = state
+        
+        aquired_context = state["exploration_queue"]
+        if aquired_context == []:
+            return state
+
+        self.fold_context(state, aquired_context)
         state["exploration_queue"] = []
         return state
 
@@ -288,19 +579,104 @@ class RFERag:
         This node is responsible for giving the final answer to the user.
         """
         self.last_state = state
+        self.collect_pending_explorations(state)
+
+        if state.get("batch_prompts", []) != []:
+            state["final_answers"] = self.give_batch_answers(state)
+            state["final_answer"] = "\n\n".join(state["final_answers"])
+            return state
         
-        prompt_with_context = f"""
-        {state['main_prompt']}
+        final_answer = self.answer_from_context(state, state['main_prompt'])
+        state["final_answer"] = final_answer
+        self.last_state = state
+        return state
 
+    def answer_from_context(self, state: State, prompt: str) -> str:
+        """
+        Answers the prompt with what is known about the project, the prompt is assembled with the datasources
+        before the question and the notes after it, so the calls share the longest possible prefix.
+        """
+        def render(variables: dict) -> str:
+            return assemble_prompt([
+                ("static", "Answer the prompt based on what you know about the project."),
+                ("datasource", variables["datasources"]),
+                ("question", f"""
+        Prompt:
+        {prompt}
+        """),
+                ("round", f"""
         [[Start of what you know about the project]]
-        {format_current_context(state)}
+        {variables["project_notes"]}
         [[End of what you know about the project]]
+        """)
+            ])
+        prompt_with_context = self.fit_prompt(state, "give_final_answer", render, {
+            "datasources": format_datasources(state),
+            "project_notes": format_project_notes(state)
+        }, ["project_notes"])
+
+        response = self.get_llm("give_final_answer").invoke(prompt_with_context)
+        self.prompt_cache_metrics.record(response)
+        return response.content
+
+    def give_batch_answers(self, state: State) -> List[str]:
+        """
+        Answers all the questions of the batch with a single call, from the shared context.
+        The questions that are missing in the structured answer are answered one by one.
         """
+        batch_prompts = state["batch_prompts"]
+        questions = "\n".join(f"{i + 1}. {prompt}" for i, prompt in enumerate(batch_prompts))
+
+        def render(variables: dict) -> str:
+            return assemble_prompt([
+                ("static", """
+        Answer each one of the following questions, using the numbers of the questions as keys.
+        Your answer should follow the format below:
+        {
+            "answers": {
+                "1": "answer to the first question",
+                "2": "answer to the second question"
+            }
+        }
+        """),
+                ("datasource", variables["datasources"]),
+                ("question", f"""
+        Questions:
+        {questions}
+        """),
+                ("round", f"""
+        [[Start of what you know about the project]]
+        {variables["project_notes"]}
+        [[End of what you know about the project]]
+        """)
+            ])
+        prompt_with_context = self.fit_prompt(state, "give_final_answer", render, {
+            "datasources": format_datasources(state),
+            "project_notes": format_project_notes(state)
+        }, ["project_notes"])
 
-        final_answer = self.llm.invoke(prompt_with_context).content
-        state["final_answer"] = final_answer
-        self.last_state = state
-        return state
+        try:
+            structured_llm = self.get_llm("give_final_answer", structured=True)
+            result = self.prompt_cache_metrics.record_structured(
+                structured_llm.with_structured_output(PydanticBatchAnswer, include_raw=True).invoke(prompt_with_context)
+            )
+            if result is None:
+                response = structured_llm.invoke(prompt_with_context)
+                self.prompt_cache_metrics.record(response)
+                answers = json.loads(response.content).get("answers", {})
+            else:
+                answers = result.answers
+        except Exception as e:
+            print(f"Error with the model response: {e}")
+            answers = {}
+
+        final_answers = []
+        for i, prompt in enumerate(batch_prompts):
+            answer = answers.get(str(i + 1))
+            if answer is None:
+                answer = self.answer_from_context(state, prompt)
+            final_answers.append(answer)
+        return final_answers
 
     def display_app_graph(self) -> None:
         """
@@ -323,33 +699,155 @@ class RFERag:
             None
         """
         source_path = os.path.abspath(source_path).replace("\\", "/") + "/"
-        self.datasources[source_path] = list_avaliable_relative_files(source_path)
+        relative_files = list_avaliable_relative_files(source_path)
+        with self.datasources_lock:
+            self.datasources[source_path] = relative_files
 
-
-    def answer(self, prompt: str) -> Dict[str, str]:
+    def get_datasources_snapshot(self) -> Dict[str, List[str]]:
         """
-        Answers a given prompt by following the state graph workflow.
+        Returns a copy of the datasources, so each request keeps the same files even if a datasource is added meanwhile.
         """
-        # initialize the state
+        with self.datasources_lock:
+            return {source_path: list(files) for source_path, files in self.datasources.items()}
+
+
+    def get_initial_state(self, prompt: str, datasources: Dict[str, List[str]] = None) -> State:
+        if datasources is None:
+            datasources = self.get_datasources_snapshot()
         state = {
             "main_prompt": prompt,
             "dynamic_context": "No information about the project yet",
-            "datasources": self.datasources,
+            "datasources": datasources,
             "exploration_queue": [],
             "final_answer": "",
             "exploration_counter": 0,
-            "num_explorations": 0
+            "num_explorations": 0,
+            "pending_explorations": [],
+            "token_trace": [],
+            "started_at": time.time(),
+            "exploration_scores": []
         }
-        state = State(**state)
+        return State(**state)
+
+    def run_graph(self, state: State, run_id: str = None) -> State:
+        """
+        Runs the graph from the given initial state. With a checkpoint store, the state is saved after each node
+        with the run id, and if the run already has checkpoints for the same question it is resumed from the node
+        after the last one (or its final state is returned if it had finished).
+        """
+        if self.checkpoint_store is None:
+            return self.app.invoke(state)
+
+        if run_id is None:
+            run_id = uuid.uuid4().hex
+        state["run_id"] = run_id
+        checkpoint = self.checkpoint_store.load(run_id)
+        if checkpoint is not None:
+            _, next_node, saved_state = checkpoint
+            if saved_state.get("main_prompt") == state["main_prompt"] and saved_state.get("batch_prompts") == state.get("batch_prompts"):
+                if next_node == END_NODE:
+                    return State(**saved_state)
+                print(f"Resuming the run {run_id} at the node {next_node}")
+                state = State(**saved_state, resume_node=next_node)
+                # the time while the run was interrupted doesn't count for the latency budget, only the time
+                # until its last context evaluation
+                scores = state.get("exploration_scores", [])
+                state["started_at"] = time.time() - (scores[-1]["elapsed"] if len(scores) > 0 else 0)
+            else:
+                print(f"The checkpoints of the run {run_id} are from another question, starting it again")
+                self.checkpoint_store.delete(run_id)
+
+        try:
+            return self.app.invoke(state)
+        except Exception:
+            print(f"The run {run_id} was interrupted, call it again with run_id='{run_id}' to resume from the last completed node")
+            raise
+
+    def answer(self, prompt: str, run_id: str = None) -> Dict[str, str]:
+        """
+        Answers a given prompt by following the state graph workflow.
+        The result has the token counts of each prompt sent to the models in "token_trace".
+        If there is a checkpoint store, the run is saved with the run id (a new one if None, returned in "run_id"),
+        and calling it again with the same run id resumes the run from its last completed node.
+        If there is an answer cache, the cached answer for the same question and datasources version is returned,
+        with "cache_hit" as True in the result.
+        The result also has the prompt cache usage of the models of this instance so far in "prompt_cache_metrics".
+        """
+        datasources = self.get_datasources_snapshot()
+        if self.answer_cache is not None:
+            fingerprint = datasources_fingerprint(datasources)
+            cached_result = self.answer_cache.get(prompt, fingerprint)
+            if cached_result is not None:
+                return {**cached_result, "cache_hit": True, "prompt_cache_metrics": self.prompt_cache_metrics.summary()}
+
+        # initialize the state
+        state = self.get_initial_state(prompt, datasources)
         # run the application
-        final_state = self.app.invoke(state)
+        final_state = self.run_graph(state, run_id)
 
         answer = final_state["final_answer"]
         context = format_current_context(final_state)
 
-        return {
+        result = {
             "answer": answer,
             "context": context,
             "exploration_counter": final_state["exploration_counter"],
-            "num_explorations": final_state["num_explorations"]
+            "num_explorations": final_state["num_explorations"],
+            "cache_hit": False,
+            "token_trace": final_state.get("token_trace", []),
+            "run_id": final_state.get("run_id"),
+            "stop_reason": final_state.get("stop_reason"),
+            "exploration_scores": final_state.get("exploration_scores", [])
         }
+        if self.answer_cache is not None:
+            self.answer_cache.put(prompt, fingerprint, result)
+        return {**result, "prompt_cache_metrics": self.prompt_cache_metrics.summary()}
+
+    def answer_batch(self, prompts: List[str], run_id: str = None) -> List[Dict[str, str]]:
+        """
+        Answers several related questions with a single exploration session.
+
+        The exploration is planned for all the questions together, so each file is explored once with the
+        combined questions, and the final answers of all the questions are given from the shared notes.
+
+        Returns:
+            List[Dict[str, str]]: the results in the same format of the answer method, one for each prompt.
+                The context, the exploration counters and the run id are shared by all of them.
+        """
+        results = [None] * len(prompts)
+        datasources = self.get_datasources_snapshot()
+        if self.answer_cache is not None:
+            fingerprint = datasources_fingerprint(datasources)
+            for i, prompt in enumerate(prompts):
+                cached_result = self.answer_cache.get(prompt, fingerprint)
+                if cached_result is not None:
+                    results[i] = {**cached_result, "cache_hit": True, "prompt_cache_metrics": self.prompt_cache_metrics.summary()}
+
+        # only the questions without cached answers are explored
+        missing = [i for i, result in enumerate(results) if result is None]
+        if len(missing) == 0:
+            return results
+        missing_prompts = [prompts[i] for i in missing]
+
+        questions = "\n".join(f"{i + 1}. {prompt}" for i, prompt in enumerate(missing_prompts))
+        state = self.get_initial_state(f"Answer all the following questions:\n{questions}", datasources)
+        state["batch_prompts"] = missing_prompts
+        final_state = self.run_graph(state, run_id)
+
+        context = format_current_context(final_state)
+        for i, answer in zip(missing, final_state["final_answers"]):
+            results[i] = {
+                "answer": answer,
+                "context": context,
+                "exploration_counter": final_state["exploration_counter"],
+                "num_explorations": final_state["num_explorations"],
+                "cache_hit": False,
+                "token_trace": final_state.get("token_trace", []),
+                "run_id": final_state.get("run_id"),
+                "stop_reason": final_state.get("stop_reason"),
+                "exploration_scores": final_state.get("exploration_scores", [])
+            }
+            if self.answer_cache is not None:
+                self.answer_cache.put(prompts[i], fingerprint, results[i])
+            results[i] = {**results[i], "prompt_cache_metrics": self.prompt_cache_metrics.summary()}
+        return results
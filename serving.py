@@ -0,0 +1,167 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from recursive_file_exploration_rag import RFERag
+
+class ServerBusyError(Exception):
+    pass
+
+class ConcurrencyLimiter:
+    """
+    Limits the number of requests answered at the same time, keeping a bounded queue of waiting requests.
+    The requests that find the queue full, or wait longer than the queue timeout, are rejected, so the server
+    applies backpressure instead of piling up requests it can't answer.
+    """
+    def __init__(self, max_concurrency: int = 4, max_queue: int = 16, queue_timeout: float = 30):
+        """
+        Args:
+            max_concurrency (int): the number of requests answered at the same time
+            max_queue (int): the maximum number of requests waiting for their turn
+            queue_timeout (float): the maximum time in seconds that a request waits in the queue
+        """
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.queued = 0
+
+    def __enter__(self):
+        with self.lock:
+            if self.queued >= self.max_queue:
+                raise ServerBusyError(f"The queue is full ({self.queued} requests waiting)")
+            self.queued += 1
+        acquired = self.semaphore.acquire(timeout=self.queue_timeout)
+        with self.lock:
+            self.queued -= 1
+            if acquired:
+                self.active += 1
+        if not acquired:
+            raise ServerBusyError(f"The request waited more than {self.queue_timeout} seconds in the queue")
+        return self
+
+    def __exit__(self, *exc_info):
+        with self.lock:
+            self.active -= 1
+        self.semaphore.release()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "active": self.active,
+                "queued": self.queued,
+                "max_concurrency": self.max_concurrency,
+                "max_queue": self.max_queue
+            }
+
+class RFERagRequestHandler(BaseHTTPRequestHandler):
+    """
+    Routes:
+        POST /answer: {"prompt": "...", "run_id": optional} -> the result of RFERag.answer
+        POST /answer_batch: {"prompts": ["...", ...], "run_id": optional} -> {"results": the results of RFERag.answer_batch}
+        GET /health: the number of active and queued requests
+    """
+    # set by serve
+    rag: RFERag = None
+    limiter: ConcurrencyLimiter = None
+    retry_after: int = 5
+
+    def send_json(self, status: int, body: dict, headers: dict = {}) -> None:
+        data = json.dumps(body, ensure_ascii=False, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length).decode("utf-8")) if length > 0 else {}
+        if not isinstance(body, dict):
+            raise ValueError("The body should be a json object")
+        return body
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok", **self.limiter.stats()})
+        else:
+            self.send_json(404, {"error": f"Unknown path: {self.path}"})
+
+    def do_POST(self):
+        if self.path not in ["/answer", "/answer_batch"]:
+            self.send_json(404, {"error": f"Unknown path: {self.path}"})
+            return
+        try:
+            body = self.read_json()
+            if self.path == "/answer" and not isinstance(body.get("prompt"), str):
+                raise ValueError("'prompt' should be a string")
+            if self.path == "/answer_batch":
+                prompts = body.get("prompts")
+                if not isinstance(prompts, list) or not all(isinstance(prompt, str) for prompt in prompts):
+                    raise ValueError("'prompts' should be a list of strings")
+            if body.get("run_id") is not None and not isinstance(body["run_id"], str):
+                raise ValueError("'run_id' should be a string")
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+
+        try:
+            with self.limiter:
+                if self.path == "/answer":
+                    response = self.rag.answer(body["prompt"], run_id=body.get("run_id"))
+                else:
+                    response = {"results": self.rag.answer_batch(body["prompts"], run_id=body.get("run_id"))}
+        except ServerBusyError as e:
+            self.send_json(503, {"error": str(e)}, {"Retry-After": str(self.retry_after)})
+            return
+        except Exception as e:
+            print(f"Error while answering the request: {e}")
+            self.send_json(500, {"error": str(e)})
+            return
+        self.send_json(200, response)
+
+def create_server(
+        rag: RFERag,
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        max_concurrency: int = 4,
+        max_queue: int = 16,
+        queue_timeout: float = 30
+        ) -> ThreadingHTTPServer:
+    """
+    Creates a local HTTP server that answers the requests with a shared RFERag instance, each request in its own
+    thread and with its own state.
+
+    Example:
+        rag = RFERag(llm, structured_llm, "prompts", ["bases/base_conhecimento_1"], answer_cache=AnswerCache())
+        create_server(rag, port=8000, max_concurrency=4).serve_forever()
+
+    Args:
+        rag (RFERag): the shared engine, with its agents, templates and caches
+        host (str): the address of the server
+        port (int): the port of the server
+        max_concurrency (int): the number of requests answered at the same time
+        max_queue (int): the maximum number of requests waiting, the next ones receive 503
+        queue_timeout (float): the maximum time in seconds that a request waits, after that it receives 503
+    """
+    handler = type("Handler", (RFERagRequestHandler,), {
+        "rag": rag,
+        "limiter": ConcurrencyLimiter(max_concurrency, max_queue, queue_timeout)
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+def serve(rag: RFERag, host: str = "127.0.0.1", port: int = 8000, **kwargs) -> None:
+    server = create_server(rag, host, port, **kwargs)
+    print(f"Serving on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
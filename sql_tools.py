@@ -0,0 +1,393 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import pandas as pd
+from utils import normalize_prompt
+from token_budget import count_tokens
+
+# operators that can be pushed down to the file reader, mapped to the pyarrow filter syntax
+PUSHDOWN_OPERATORS = {
+    "=": "==",
+    "==": "==",
+    "!=": "!=",
+    "<>": "!=",
+    "<": "<",
+    "<=": "<=",
+    ">": ">",
+    ">=": ">="
+}
+
+def _contains_identifier(query: str, identifier: str) -> bool:
+    """
+    Checks if the identifier appears in the query as a whole word, ignoring the case.
+    Quoted identifiers ("col", [col], `col`) are also matched, since the quotes are not identifier characters.
+    """
+    pattern = r"(?<![\w])" + re.escape(identifier.lower()) + r"(?![\w])"
+    return re.search(pattern, query.lower()) is not None
+
+def references_table(query: str, table_name: str) -> bool:
+    """
+    Returns True if the table name is used in the query.
+    """
+    return _contains_identifier(query, table_name)
+
+def selects_all_columns(query: str) -> bool:
+    """
+    Returns True if the query uses a wildcard projection, like "SELECT *" or "table.*".
+    COUNT(*) does not count as a wildcard projection, since it does not need any specific column.
+    """
+    lowered = query.lower()
+    if re.search(r"select\s+(distinct\s+)?\*", lowered):
+        return True
+    if re.search(r"\.\s*\*", lowered) or re.search(r",\s*\*", lowered):
+        return True
+    return False
+
+def referenced_columns(query: str, columns: List[str]) -> List[str]:
+    """
+    Returns the columns (in the original order) that are referenced by the query.
+    The detection is conservative, a column is considered referenced if its name appears as a whole word in the query,
+    so it can load more columns than needed, but never less (except for wildcard projections, see selects_all_columns).
+
+    Args:
+        query (str): the SQLite query
+        columns (List[str]): the available column names
+
+    Returns:
+        List[str]: the referenced columns
+    """
+    return [col for col in columns if _contains_identifier(query, col)]
+
+def _parse_literal(literal: str):
+    literal = literal.strip()
+    if len(literal) >= 2 and literal[0] == literal[-1] == "'":
+        return literal[1:-1].replace("''", "'")
+    try:
+        return int(literal)
+    except ValueError:
+        pass
+    try:
+        return float(literal)
+    except ValueError:
+        return None
+
+def pushdown_filters(query: str, columns: List[str]) -> Optional[List[Tuple[str, str, object]]]:
+    """
+    Extracts simple predicates from the WHERE clause of the query that can be applied while reading the file
+    (predicate pushdown), in the format expected by pandas.read_parquet filters argument.
+
+    Only queries with a single SELECT, and a WHERE clause made only of "column <op> literal" conditions joined by AND
+    are considered, anything else returns None so the file is read without filters.
+    The query is still executed over the filtered data, so the filters are only an optimization.
+
+    Args:
+        query (str): the SQLite query
+        columns (List[str]): the available column names
+
+    Returns:
+        Optional[List[Tuple[str, str, object]]]: the list of filters or None if no filter can be safely pushed down
+    """
+    lowered = query.lower()
+    if len(re.findall(r"\bselect\b", lowered)) != 1:
+        return None
+    if re.search(r"\b(join|union|intersect|except)\b", lowered):
+        return None
+
+    where_match = re.search(r"\bwhere\b(.*?)(\bgroup\s+by\b|\border\s+by\b|\blimit\b|\bhaving\b|;|$)", query, re.IGNORECASE | re.DOTALL)
+    if where_match is None:
+        return None
+    where_clause = where_match.group(1)
+    if re.search(r"\b(or|not|between|in|like|glob|is)\b", where_clause, re.IGNORECASE) or "(" in where_clause:
+        return None
+
+    columns_by_name = {col.lower(): col for col in columns}
+    condition_pattern = re.compile(r"^\s*[\"`\[]?(.+?)[\"`\]]?\s*(==|!=|<>|<=|>=|=|<|>)\s*('(?:[^']|'')*'|-?\d+(?:\.\d+)?)\s*$", re.DOTALL)
+
+    filters = []
+    for condition in re.split(r"\band\b", where_clause, flags=re.IGNORECASE):
+        match = condition_pattern.match(condition)
+        if match is None:
+            return None
+        column, operator, literal = match.groups()
+        column = columns_by_name.get(column.strip().lower())
+        value = _parse_literal(literal)
+        if column is None or value is None:
+            return None
+        filters.append((column, PUSHDOWN_OPERATORS[operator], value))
+
+    return filters if filters else None
+
+def replace_table_names(query: str, table_variables: Dict[str, str]) -> str:
+    """
+    Replaces the table names in the query by the names of the variables holding the dataframes.
+    The longest names are replaced first, so that a table name that contains another is not broken.
+    """
+    for table_name in sorted(table_variables, key=len, reverse=True):
+        pattern = r"(?<![\w])" + re.escape(table_name) + r"(?![\w])"
+        query = re.sub(pattern, table_variables[table_name], query, flags=re.IGNORECASE)
+    return query
+
+def validate_query(query: str, tables: Dict[str, List[str]]) -> Optional[str]:
+    """
+    Validates the query against the schema of the tables, without any data, preparing it with EXPLAIN
+    on an in-memory SQLite database with empty tables.
+
+    Args:
+        query (str): the SQLite query
+        tables (Dict[str, List[str]]): a dictionary mapping the table names to their column names
+
+    Returns:
+        Optional[str]: the error message, or None if the query is valid
+    """
+    table_variables = {table_name: f"local_df_variable_{i}" for i, table_name in enumerate(tables)}
+    connection = sqlite3.connect(":memory:")
+    try:
+        for table_name, columns in tables.items():
+            columns_definition = ", ".join(quote_identifier(col) for col in columns)
+            connection.execute(f"CREATE TABLE {table_variables[table_name]} ({columns_definition})")
+        connection.execute("EXPLAIN " + strip_query(replace_table_names(query, table_variables)))
+    except sqlite3.Error as e:
+        # show the original table names in the error message
+        error = str(e)
+        for table_name, variable in table_variables.items():
+            error = error.replace(variable, table_name)
+        return error
+    finally:
+        connection.close()
+    return None
+
+def strip_query(query: str) -> str:
+    """
+    Removes the trailing semicolons and whitespaces of the query, so it can be used as a subquery.
+    """
+    return query.strip().rstrip(";").strip()
+
+def is_select_query(query: str) -> bool:
+    return re.match(r"^\s*(select|with)\b", query, re.IGNORECASE) is not None
+
+def quote_identifier(identifier: str) -> str:
+    return '"' + str(identifier).replace('"', '""') + '"'
+
+class QueryResultGovernor:
+    """
+    Governs the size of the query results that are added to the context.
+
+    The query is executed with an automatic LIMIT, and the result is rendered in a compact format (csv or markdown)
+    within the row, byte and token limits. When the result doesn't fit, only the first rows are shown, together with
+    the total number of rows and an aggregate summary of each column computed over the whole result.
+    """
+    def __init__(self, max_rows: int = 50, max_bytes: int = 8000, max_tokens: int = 1500, output_format: str = "csv", max_cell_chars: int = 200):
+        """
+        Args:
+            max_rows (int): the maximum number of rows fetched and shown
+            max_bytes (int): the maximum size of the rendered result, in bytes
+            max_tokens (int): the maximum size of the rendered result, in tokens
+            output_format (str): "csv" or "markdown"
+            max_cell_chars (int): values longer than this are truncated
+        """
+        if output_format not in ["csv", "markdown"]:
+            raise ValueError(f"Unsupported output format: {output_format}")
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_tokens = max_tokens
+        self.output_format = output_format
+        self.max_cell_chars = max_cell_chars
+
+    def limit_query(self, query: str) -> str:
+        """
+        Wraps the query to fetch at most max_rows + 1 rows, the extra row tells if the result was truncated.
+        """
+        query = strip_query(query)
+        if not is_select_query(query):
+            return query
+        return f"SELECT * FROM ({query}) LIMIT {self.max_rows + 1}"
+
+    def count_query(self, query: str) -> str:
+        return f"SELECT COUNT(*) AS num_rows FROM ({strip_query(query)})"
+
+    def aggregate_query(self, query: str, df) -> str:
+        """
+        Returns a query that summarizes each column of the result of the query.
+        """
+        aggregates = []
+        for i, col in enumerate(df.columns):
+            quoted = quote_identifier(col)
+            if pd.api.types.is_numeric_dtype(df[col]):
+                aggregates += [f"MIN({quoted}) AS min_{i}", f"MAX({quoted}) AS max_{i}", f"AVG({quoted}) AS avg_{i}"]
+            else:
+                aggregates += [f"COUNT(DISTINCT {quoted}) AS distinct_{i}"]
+        return f"SELECT {', '.join(aggregates)} FROM ({strip_query(query)})"
+
+    def format_rows(self, df) -> str:
+        df = df.copy()
+        for col in df.columns:
+            if df[col].dtype == 'object':
+                df[col] = df[col].astype(str).map(
+                    lambda value: value if len(value) <= self.max_cell_chars else value[:self.max_cell_chars] + "..."
+                )
+        if self.output_format == "csv":
+            return df.to_csv(index=False)
+
+        lines = [
+            "| " + " | ".join(str(col) for col in df.columns) + " |",
+            "| " + " | ".join("---" for _ in df.columns) + " |"
+        ]
+        for row in df.itertuples(index=False):
+            lines.append("| " + " | ".join(str(value).replace("|", "\\|").replace("\n", " ") for value in row) + " |")
+        return "\n".join(lines) + "\n"
+
+    def fits(self, text: str) -> bool:
+        return len(text.encode("utf-8")) <= self.max_bytes and count_tokens(text) <= self.max_tokens
+
+    def summarize(self, query: str, df, execute) -> str:
+        """
+        Returns a text with aggregates of each column of the whole result of the query.
+        """
+        try:
+            aggregates = execute(self.aggregate_query(query, df)).to_dict("records")[0]
+        except Exception:
+            # the aggregates can't be computed in SQL, describe just the fetched rows
+            return "summary of the first rows:\n" + df.describe(include="all").to_csv()
+
+        lines = []
+        for i, col in enumerate(df.columns):
+            if f"min_{i}" in aggregates:
+                lines.append(f"{col}: min {aggregates[f'min_{i}']}, max {aggregates[f'max_{i}']}, avg {aggregates[f'avg_{i}']}")
+            else:
+                lines.append(f"{col}: {aggregates[f'distinct_{i}']} distinct values")
+        return "summary of all the rows:\n" + "\n".join(lines)
+
+    def run(self, query: str, execute) -> str:
+        """
+        Executes the query with the limits and renders the result.
+
+        Args:
+            query (str): the SQLite query
+            execute (Callable[[str], pd.DataFrame]): function that executes a SQLite query over the tables
+
+        Returns:
+            str: the rendered result
+        """
+        limited_query = self.limit_query(query)
+        df = execute(limited_query)
+        if df is None:
+            return "The query didn't return any result."
+
+        total_rows = len(df)
+        if limited_query != strip_query(query) and total_rows > self.max_rows:
+            total_rows = int(execute(self.count_query(query)).iloc[0, 0])
+        df = df.head(self.max_rows)
+
+        rendered = self.format_rows(df)
+        if total_rows == len(df) and self.fits(rendered):
+            return rendered
+
+        # the result is too large, show only the rows that fit together with a summary
+        summary = self.summarize(query, df, execute)
+        num_rows = len(df)
+        while True:
+            note = f"The result has {total_rows} rows, showing the first {num_rows}.\n"
+            rendered = note + self.format_rows(df.head(num_rows)) + "\n" + summary
+            if self.fits(rendered) or num_rows == 0:
+                break
+            num_rows = num_rows // 2
+
+        if not self.fits(rendered):
+            rendered = rendered.encode("utf-8")[:self.max_bytes].decode("utf-8", errors="ignore") + "\n[result truncated]"
+        return rendered
+
+def schema_fingerprint(tables: Dict[str, List[str]]) -> str:
+    """
+    Returns a fingerprint of the tables and columns names, it changes whenever the schema of the file changes.
+    """
+    description = json.dumps({table_name: list(columns) for table_name, columns in tables.items()}, sort_keys=True)
+    return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+class SQLPlanCache:
+    """
+    Cache of validated queries, keyed by the normalized specific prompt and the schema fingerprint of the file.
+    A cached query is executed again on the current data of the file, without asking the language model for a new query.
+
+    The entries are evicted in least recently used order when the cache is full, and the entries of a file are
+    invalidated when its schema fingerprint changes.
+    If a cache file is given, the entries are also persisted as json.
+    """
+    def __init__(self, max_entries: int = 256, cache_file: str = None):
+        """
+        Args:
+            max_entries (int): the maximum number of cached queries
+            cache_file (str): the json file where the entries are persisted, if None they are kept only in memory
+        """
+        self.max_entries = max_entries
+        self.cache_file = cache_file
+        # (normalized prompt, fingerprint) -> {"file_path": ..., "query": ...}
+        self.entries = OrderedDict()
+        self.file_fingerprints = {}
+        self.lock = threading.Lock()
+        if cache_file is not None and os.path.exists(cache_file):
+            self.load()
+
+    def invalidate_file(self, file_path: str, fingerprint: str) -> None:
+        """
+        Removes the entries of the file that were created with a different schema.
+        """
+        if self.file_fingerprints.get(file_path, fingerprint) == fingerprint:
+            self.file_fingerprints[file_path] = fingerprint
+            return
+        self.file_fingerprints[file_path] = fingerprint
+        for key in [key for key, entry in self.entries.items() if entry["file_path"] == file_path and key[1] != fingerprint]:
+            del self.entries[key]
+
+    def get(self, file_path: str, specific_prompt: str, fingerprint: str) -> Optional[str]:
+        """
+        Returns the cached query for the prompt and schema, or None if there is no cached query.
+        """
+        key = (normalize_prompt(specific_prompt), fingerprint)
+        with self.lock:
+            self.invalidate_file(file_path, fingerprint)
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry["query"]
+
+    def put(self, file_path: str, specific_prompt: str, fingerprint: str, query: str) -> None:
+        key = (normalize_prompt(specific_prompt), fingerprint)
+        with self.lock:
+            self.invalidate_file(file_path, fingerprint)
+            self.entries[key] = {"file_path": file_path, "query": query}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            if self.cache_file is not None:
+                self.save()
+
+    def remove(self, specific_prompt: str, fingerprint: str) -> None:
+        with self.lock:
+            self.entries.pop((normalize_prompt(specific_prompt), fingerprint), None)
+            if self.cache_file is not None:
+                self.save()
+
+    def save(self) -> None:
+        data = [{"prompt": key[0], "fingerprint": key[1], **entry} for key, entry in self.entries.items()]
+        try:
+            with open(self.cache_file, "w", encoding="utf-8") as file:
+                json.dump(data, file)
+        except Exception as e:
+            print(f"An error occurred while writing the plan cache: {str(e)}")
+
+    def load(self) -> None:
+        try:
+            with open(self.cache_file, "r", encoding="utf-8") as file:
+                data = json.load(file)
+        except Exception as e:
+            print(f"An error occurred while reading the plan cache: {str(e)}")
+            return
+        for entry in data[-self.max_entries:]:
+            self.entries[(entry["prompt"], entry["fingerprint"])] = {"file_path": entry["file_path"], "query": entry["query"]}
+            self.file_fingerprints[entry["file_path"]] = entry["fingerprint"]
@@ -0,0 +1,381 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from typing import Dict, Iterable, List
+
+import numpy as np
+import pandas as pd
+
+from token_budget import count_tokens
+
+# strings with this format are treated as dates, e.g.: 2024-12-01, 2024/12/01 10:00, 01/12/2024
+DATE_PATTERN = re.compile(r"^\s*(\d{4}[-/]\d{1,2}[-/]\d{1,2}|\d{1,2}[-/]\d{1,2}[-/]\d{4})([ T]\d{1,2}:\d{2}(:\d{2}(\.\d+)?)?)?\s*$")
+
+class ColumnStatistics:
+    """
+    Streaming statistics of a single column, updated chunk by chunk so the table never needs to be fully loaded.
+
+    Attributes:
+        name (str): the name of the column
+        kind (str): one of "numeric", "date", "string", "boolean" or "categorical"
+        dtype (str): the pandas dtype of the column
+        count (int): the number of values seen
+        null_count (int): the number of null values seen
+        min, max: the minimum and maximum values, for numeric and date columns
+        total (float): the sum of the values, for numeric columns
+        top_values (Dict[str, int]): approximate counts of the most frequent values, for string-like columns
+    """
+    # number of smallest hashes kept to estimate the distinct count (KMV sketch)
+    distinct_sketch_size = 256
+    # number of values whose frequency is tracked, the ones with the lowest counts are discarded
+    top_values_capacity = 100
+
+    def __init__(self, name: str, kind: str, dtype: str):
+        self.name = name
+        self.kind = kind
+        self.dtype = dtype
+        self.count = 0
+        self.null_count = 0
+        self.min = None
+        self.max = None
+        self.total = 0.0
+        self.top_values = {}
+        self.hashes = np.array([], dtype=np.uint64)
+        self.saturated = False
+
+    @staticmethod
+    def infer_kind(series: pd.Series) -> str:
+        if pd.api.types.is_bool_dtype(series):
+            return "boolean"
+        if pd.api.types.is_numeric_dtype(series):
+            return "numeric"
+        if pd.api.types.is_datetime64_any_dtype(series):
+            return "date"
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            return "categorical"
+        values = series.dropna()
+        if len(values) > 0 and values.astype(str).str.match(DATE_PATTERN).all():
+            return "date"
+        return "string"
+
+    def update(self, series: pd.Series) -> None:
+        """
+        Updates the statistics with a new chunk of the column.
+        """
+        if self.count == self.null_count:
+            # the chunks with only nulls don't tell the kind of the column
+            self.kind = self.infer_kind(series)
+        self.update_dtype(series.dtype)
+        self.count += len(series)
+        values = series.dropna()
+        self.null_count += len(series) - len(values)
+        if len(values) == 0:
+            return
+
+        self.update_distinct(values)
+
+        if self.kind == "numeric":
+            self.update_range(values.min(), values.max())
+            self.total += float(values.sum())
+        elif self.kind == "date":
+            if not pd.api.types.is_datetime64_any_dtype(values):
+                values = pd.to_datetime(values.astype(str), errors="coerce").dropna()
+            if len(values) > 0:
+                self.update_range(values.min(), values.max())
+        else:
+            self.update_top_values(values.astype(str).value_counts())
+
+    def update_dtype(self, dtype) -> None:
+        """
+        Combines the dtype of a new chunk with the dtype of the column, e.g. an int64 column becomes float64
+        when a chunk has nulls.
+        """
+        if str(dtype) == self.dtype:
+            return
+        try:
+            self.dtype = str(np.result_type(np.dtype(self.dtype), dtype))
+        except TypeError:
+            self.dtype = "object"
+
+    def update_range(self, chunk_min, chunk_max) -> None:
+        self.min = chunk_min if self.min is None else min(self.min, chunk_min)
+        self.max = chunk_max if self.max is None else max(self.max, chunk_max)
+
+    def update_distinct(self, values: pd.Series) -> None:
+        if self.kind == "numeric" and pd.api.types.is_numeric_dtype(values):
+            # the same number hashes the same in the chunks read as int and in the ones read as float (with nulls)
+            values = values.astype("float64")
+        else:
+            values = values.astype(str)
+        hashes = pd.util.hash_pandas_object(values, index=False).to_numpy(dtype=np.uint64)
+        hashes = np.unique(np.concatenate([self.hashes, hashes]))
+        if len(hashes) > self.distinct_sketch_size:
+            self.saturated = True
+        self.hashes = hashes[:self.distinct_sketch_size]
+
+    def update_top_values(self, counts: pd.Series) -> None:
+        for value, count in counts.items():
+            self.top_values[value] = self.top_values.get(value, 0) + int(count)
+        if len(self.top_values) > self.top_values_capacity:
+            kept = sorted(self.top_values.items(), key=lambda item: item[1], reverse=True)[:self.top_values_capacity]
+            self.top_values = dict(kept)
+
+    @property
+    def distinct_count(self) -> int:
+        """
+        Exact number of distinct values when it is small, otherwise an estimate from the k smallest hashes.
+        """
+        if not self.saturated:
+            return len(self.hashes)
+        kth_hash = float(self.hashes[-1]) / float(np.iinfo(np.uint64).max)
+        return int((self.distinct_sketch_size - 1) / kth_hash)
+
+    def render(self, detailed: bool = True, with_values: bool = True) -> str:
+        """
+        Returns a single line describing the column, with the top values only if detailed is True,
+        and only with its name and type if with_values is False.
+        """
+        column_type = "string" if self.dtype == "object" else self.dtype
+        if self.kind == "date" and column_type == "string":
+            column_type = "string with dates"
+        line = f"{self.name} ({column_type})"
+        if not with_values:
+            return line
+        if self.null_count > 0:
+            line += f", nulls: {self.null_count}"
+        distinct_prefix = "~" if self.saturated else ""
+        line += f", distinct: {distinct_prefix}{self.distinct_count}"
+
+        if self.kind == "numeric" and self.min is not None:
+            line += f", min: {self.min}, max: {self.max}"
+            if self.count - self.null_count > 0:
+                line += f", mean: {self.total / (self.count - self.null_count):.6g}"
+        elif self.kind == "date" and self.min is not None:
+            start, end = pd.Timestamp(self.min), pd.Timestamp(self.max)
+            if start == start.normalize() and end == end.normalize():
+                start, end = start.date(), end.date()
+            line += f", from {start.isoformat()} to {end.isoformat()}"
+        elif detailed and len(self.top_values) > 0:
+            top_values = sorted(self.top_values.items(), key=lambda item: item[1], reverse=True)[:5]
+            line += ", top values: " + ", ".join(f"'{value}' ({count})" for value, count in top_values)
+        return line
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "dtype": self.dtype,
+            "count": self.count,
+            "null_count": self.null_count,
+            "min": self.serialize_value(self.min),
+            "max": self.serialize_value(self.max),
+            "total": self.total,
+            "top_values": self.top_values,
+            "hashes": [int(h) for h in self.hashes],
+            "saturated": self.saturated
+        }
+
+    def serialize_value(self, value):
+        if value is None:
+            return None
+        if self.kind == "date":
+            return pd.Timestamp(value).isoformat()
+        return value.item() if hasattr(value, "item") else value
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "ColumnStatistics":
+        column = cls(data["name"], data["kind"], data["dtype"])
+        column.count = data["count"]
+        column.null_count = data["null_count"]
+        column.min = data["min"]
+        column.max = data["max"]
+        if column.kind == "date" and column.min is not None:
+            column.min = pd.Timestamp(column.min)
+            column.max = pd.Timestamp(column.max)
+        column.total = data["total"]
+        column.top_values = data["top_values"]
+        column.hashes = np.array(data["hashes"], dtype=np.uint64)
+        column.saturated = data["saturated"]
+        return column
+
+
+class TableStatistics:
+    """
+    Statistics of all the columns of a table.
+
+    Attributes:
+        num_rows (int): the number of rows of the table
+        columns (Dict[str, ColumnStatistics]): the statistics of each column
+    """
+    def __init__(self, num_rows: int = 0, columns: Dict[str, ColumnStatistics] = None):
+        self.num_rows = num_rows
+        self.columns = columns if columns is not None else {}
+
+    @classmethod
+    def from_chunks(cls, chunks: Iterable[pd.DataFrame]) -> "TableStatistics":
+        """
+        Computes the statistics streaming over the chunks of the table.
+        """
+        statistics = cls()
+        for chunk in chunks:
+            statistics.num_rows += len(chunk)
+            for col in chunk.columns:
+                if col not in statistics.columns:
+                    kind = ColumnStatistics.infer_kind(chunk[col])
+                    statistics.columns[col] = ColumnStatistics(col, kind, str(chunk[col].dtype))
+                statistics.columns[col].update(chunk[col])
+        return statistics
+
+    def render(self, table_name: str, max_tokens: int = None, sample: pd.DataFrame = None, from_sample: bool = False) -> str:
+        """
+        Renders the statistics as a table summary, reducing the level of detail until it fits the token budget:
+        first the top values of the columns are removed, then the sample rows, and then the columns are cut.
+
+        Args:
+            table_name (str): the name of the table
+            max_tokens (int): the maximum number of tokens of the summary, no limit if None
+            sample (pd.DataFrame): the first rows of the table, to be shown as an example
+            from_sample (bool): whether the statistics were computed only from the sample rows, in which case only the
+                types of the columns are shown, and num_rows is the real number of rows of the table (None if unknown)
+
+        Returns:
+            str: the summary of the table
+        """
+        rows = f"{self.num_rows} rows" if self.num_rows is not None else "an unknown number of rows"
+        header = f"""
+        summary of the table {table_name}: {rows} and {len(self.columns)} columns
+
+        columns:
+        """
+        if from_sample:
+            header = f"""
+        summary of the table {table_name}: {rows} and {len(self.columns)} columns
+        (there are no statistics of the values of this table, the types of the columns were inferred from its first rows)
+
+        columns:
+        """
+        sample_text = ""
+        if sample is not None and len(sample) > 0:
+            sample_text = f"""
+        the first {len(sample)} rows are:
+        {sample}
+        """
+
+        def build(lines: List[str], sample_text: str) -> str:
+            return header + "\n".join(lines) + "\n" + sample_text
+
+        with_values = not from_sample
+        attempts = [
+            ([column.render(detailed=True, with_values=with_values) for column in self.columns.values()], sample_text),
+            ([column.render(detailed=False, with_values=with_values) for column in self.columns.values()], sample_text),
+            ([column.render(detailed=False, with_values=with_values) for column in self.columns.values()], "")
+        ]
+        for lines, sample_text in attempts:
+            summary = build(lines, sample_text)
+            if max_tokens is None or count_tokens(summary) <= max_tokens:
+                return summary
+
+        # even without details the columns don't fit, keep as many columns as possible
+        lines = attempts[-1][0]
+        while len(lines) > 1 and count_tokens(build(lines, "")) > max_tokens:
+            lines = lines[:-1]
+        lines.append(f"... and {len(self.columns) - len(lines)} more columns")
+        return build(lines, "")
+
+    def to_dict(self) -> dict:
+        return {
+            "num_rows": self.num_rows,
+            "columns": [column.to_dict() for column in self.columns.values()]
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "TableStatistics":
+        columns = [ColumnStatistics.from_dict(column) for column in data["columns"]]
+        return cls(data["num_rows"], {column.name: column for column in columns})
+
+
+class StatisticsStore:
+    """
+    Stores the statistics of the tables of each file version, so they are computed only once.
+    The file version is given by its modification time and size, so the statistics are recomputed when the file changes.
+
+    If a cache folder is given, the statistics are also persisted as json files, one for each data file.
+    """
+    def __init__(self, cache_folder: str = None):
+        """
+        Args:
+            cache_folder (str): the folder where the statistics are persisted, if None they are kept only in memory
+        """
+        self.cache_folder = cache_folder
+        if cache_folder is not None:
+            os.makedirs(cache_folder, exist_ok=True)
+        self.memory = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_file_version(file_path: str) -> str:
+        stat = os.stat(file_path)
+        return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+    def get_cache_file(self, file_path: str) -> str:
+        file_key = hashlib.sha1(os.path.abspath(file_path).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_folder, file_key + ".json")
+
+    def load(self, file_path: str, version: str) -> Dict[str, TableStatistics]:
+        with self.lock:
+            entry = self.memory.get(file_path)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        if self.cache_folder is None or not os.path.exists(self.get_cache_file(file_path)):
+            return None
+        try:
+            with open(self.get_cache_file(file_path), "r", encoding="utf-8") as file:
+                data = json.load(file)
+        except Exception as e:
+            print(f"An error occurred while reading the statistics cache: {str(e)}")
+            return None
+        if data.get("version") != version:
+            return None
+
+        tables = {table_name: TableStatistics.from_dict(table) for table_name, table in data["tables"].items()}
+        with self.lock:
+            self.memory[file_path] = (version, tables)
+        return tables
+
+    def save(self, file_path: str, version: str, tables: Dict[str, TableStatistics]) -> None:
+        with self.lock:
+            self.memory[file_path] = (version, tables)
+        if self.cache_folder is None:
+            return
+        data = {
+            "file_path": file_path,
+            "version": version,
+            "tables": {table_name: table.to_dict() for table_name, table in tables.items()}
+        }
+        try:
+            with open(self.get_cache_file(file_path), "w", encoding="utf-8") as file:
+                json.dump(data, file, default=str)
+        except Exception as e:
+            print(f"An error occurred while writing the statistics cache: {str(e)}")
+
+    def get_statistics(self, file_path: str, compute_statistics) -> Dict[str, TableStatistics]:
+        """
+        Returns the statistics of the tables of the file, computing them only if the current version of the file
+        has no stored statistics.
+
+        Args:
+            file_path (str): the path to the file
+            compute_statistics (Callable[[], Dict[str, TableStatistics]]): function that computes the statistics of each table of the file
+
+        Returns:
+            Dict[str, TableStatistics]: the statistics of each table of the file
+        """
+        version = self.get_file_version(file_path)
+        tables = self.load(file_path, version)
+        if tables is None:
+            tables = compute_statistics()
+            self.save(file_path, version, tables)
+        return tables
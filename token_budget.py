@@ -0,0 +1,188 @@
+from typing import Callable, List, Optional, Tuple
+
+try:
+    import tiktoken
+except ImportError:
+    # optional, without it the tokens are estimated from the number of characters
+    tiktoken = None
+
+# average number of characters per token of each model family, used when there is no local tokenizer
+CHARS_PER_TOKEN = {
+    "gpt": 4.0,
+    "llama": 3.7,
+    "qwen": 3.3,
+    "default": 3.5
+}
+
+# context window of each model family served by a hosted api, in tokens
+CONTEXT_WINDOWS = {
+    "gpt": 128000,
+    "llama": 128000,
+    "qwen": 32768
+}
+
+# fraction of the context window reserved for the answer of the model
+RESERVED_OUTPUT_RATIO = 0.125
+
+def get_model_name(llm) -> str:
+    for attribute in ["model_name", "model"]:
+        name = getattr(llm, attribute, None)
+        if isinstance(name, str):
+            return name
+    return ""
+
+def get_model_family(llm) -> str:
+    """
+    Returns the model family of the language model, or "default" if it is unknown.
+    Routed models and backend pools use the family of their first model.
+    """
+    for attribute in ["llms", "backends"]:
+        if hasattr(llm, attribute):
+            return get_model_family(getattr(llm, attribute)[0])
+    name = get_model_name(llm).lower()
+    for family in CHARS_PER_TOKEN:
+        if family in name:
+            return family
+    return "default"
+
+def get_context_window(llm) -> Optional[int]:
+    """
+    Returns the context window of the language model, in tokens, or None if it is not known.
+    Routed models and backend pools use the smallest context window among their models.
+
+    The window of the local models (e.g. ChatOllama) is only known when num_ctx is set, since it depends on
+    the server configuration and not on the model family.
+    """
+    for attribute in ["llms", "backends"]:
+        if hasattr(llm, attribute):
+            windows = [get_context_window(model) for model in getattr(llm, attribute)]
+            return None if None in windows else min(windows)
+    num_ctx = getattr(llm, "num_ctx", None)
+    if num_ctx:
+        return num_ctx
+    if type(llm).__name__ == "ChatOllama":
+        return None
+    return CONTEXT_WINDOWS.get(get_model_family(llm))
+
+def count_tokens(text: str, model_family: str = "default") -> int:
+    """
+    Counts the tokens of the text locally, with tiktoken for the gpt family when it is installed,
+    or estimating from the average number of characters per token of the family.
+    """
+    if model_family == "gpt" and tiktoken is not None:
+        return len(tiktoken.get_encoding("o200k_base").encode(text, disallowed_special=()))
+    return int(len(text) / CHARS_PER_TOKEN.get(model_family, CHARS_PER_TOKEN["default"])) + 1
+
+class TokenBudget:
+    """
+    Keeps the prompts within the context window of the target model.
+
+    The prompt is rendered and its tokens counted locally, and while it is larger than the context window
+    (minus the tokens reserved for the answer) the sections with the lowest priority are trimmed, or summarized
+    if a summarizer is given. The token counts of the sections are reported, to be added to the answer trace.
+    When the context window is not known the prompts are only counted, not trimmed.
+    """
+    def __init__(self, context_window: Optional[int], model_family: str = "default", reserved_output_tokens: int = None, summarizer: Callable[[str, int], str] = None):
+        """
+        Args:
+            context_window (int): the context window of the model, in tokens, or None if it is not known
+            model_family (str): the model family, used to count the tokens
+            reserved_output_tokens (int): the tokens reserved for the answer of the model, if None a fraction
+                (RESERVED_OUTPUT_RATIO) of the context window is reserved
+            summarizer (Callable[[str, int], str]): function that summarizes a text to a maximum number of tokens,
+                if None the sections are trimmed keeping their beginning and end
+        """
+        self.context_window = context_window
+        self.model_family = model_family
+        if context_window is None:
+            self.reserved_output_tokens = reserved_output_tokens
+        else:
+            if reserved_output_tokens is None:
+                reserved_output_tokens = int(context_window * RESERVED_OUTPUT_RATIO)
+            self.reserved_output_tokens = min(reserved_output_tokens, context_window // 2)
+        self.summarizer = summarizer
+
+    @classmethod
+    def for_model(cls, llm, **kwargs) -> "TokenBudget":
+        return cls(get_context_window(llm), get_model_family(llm), **kwargs)
+
+    @property
+    def available_tokens(self) -> Optional[int]:
+        if self.context_window is None:
+            return None
+        return self.context_window - self.reserved_output_tokens
+
+    def count(self, text: str) -> int:
+        return count_tokens(text, self.model_family)
+
+    def shrink(self, text: str, max_tokens: int) -> str:
+        """
+        Reduces the text to at most max_tokens, summarizing it or keeping its beginning and end.
+        """
+        tokens = self.count(text)
+        if tokens <= max_tokens:
+            return text
+        if self.summarizer is not None:
+            return self.summarizer(text, max_tokens)
+
+        removed_tokens = tokens - max_tokens
+        ratio = max_tokens / tokens
+        while True:
+            keep_chars = int(len(text) * ratio)
+            head = keep_chars * 2 // 3
+            tail = keep_chars - head
+            marker = f"\n[... about {removed_tokens} tokens were trimmed to fit the context window ...]\n"
+            shrunk = text[:head] + marker + (text[len(text) - tail:] if tail > 0 else "")
+            if self.count(shrunk) <= max_tokens or keep_chars == 0:
+                return shrunk
+            ratio *= 0.9
+
+    def fit(self, render: Callable[[dict], str], variables: dict, trimmable: List[str], name: str = "") -> Tuple[str, dict]:
+        """
+        Renders the prompt within the budget, trimming the variables in the trimmable order (the first one is the
+        lowest priority) until the prompt fits.
+
+        Args:
+            render (Callable[[dict], str]): function that renders the prompt from the variables
+            variables (dict): the variables of the prompt
+            trimmable (List[str]): the names of the variables that can be trimmed, from the lowest priority to the highest
+            name (str): the name of the prompt, used in the report
+
+        Returns:
+            Tuple[str, dict]: the prompt and a report with the token counts, like:
+                {"prompt": name, "prompt_tokens": 1234, "budget": 7000, "sections": {"file_content": 1000, ...}, "trimmed": ["file_content"]}
+        """
+        variables = dict(variables)
+        prompt = render(variables)
+        prompt_tokens = self.count(prompt)
+        trimmed = []
+        # without a known context window there is nothing to fit
+        for variable in trimmable if self.available_tokens is not None else []:
+            if prompt_tokens <= self.available_tokens:
+                break
+            text = str(variables.get(variable, ""))
+            overflow = prompt_tokens - self.available_tokens
+            variables[variable] = self.shrink(text, max(self.count(text) - overflow, 0))
+            trimmed.append(variable)
+            prompt = render(variables)
+            prompt_tokens = self.count(prompt)
+
+        if self.available_tokens is not None and prompt_tokens > self.available_tokens:
+            print(f"The prompt {name} still has {prompt_tokens} tokens after trimming, the budget is {self.available_tokens}")
+
+        report = {
+            "prompt": name,
+            "prompt_tokens": prompt_tokens,
+            "budget": self.available_tokens,
+            "sections": {key: self.count(value) for key, value in variables.items() if isinstance(value, str)},
+            "trimmed": trimmed
+        }
+        return prompt, report
+
+def record_token_report(state: dict, report: dict) -> None:
+    """
+    Adds the token report of a prompt to the answer trace of the state.
+    """
+    trace = state.get("token_trace")
+    if trace is not None:
+        trace.append(report)
@@ -1,10 +1,13 @@
 from IPython.display import Image, display
 from typing import TypedDict, Dict, List, Tuple
+from concurrent.futures import Future
 import jinja2
 import os
 from pydantic import BaseModel, Field
 from typing import Literal
 import base64
+from prompt_assembly import is_segmented_template, render_segmented_template
+import re
 
 class State(TypedDict):
     """
@@ -17,6 +20,16 @@ class State(TypedDict):
         exploration_counter (int): The current exploration counter.
         num_explorations (int): The total number of explorations.
         explored_files (List[str]): A list of explored files
+        pending_explorations (List[Tuple[str, str, Future]]): The explorations that missed the deadline of the last round, with the file path, the prompt and the future of the exploration (None when restored from a checkpoint)
+        batch_prompts (List[str]): The questions answered together when answering a batch, the main prompt combines all of them
+        final_answers (List[str]): The final answers of each question of the batch
+        token_trace (List[dict]): The token counts of each prompt sent to the models, see token_budget.py
+        run_id (str): The id of the run in the checkpoint store, see checkpoints.py
+        resume_node (str): The node where a run resumed from a checkpoint starts
+        started_at (float): The time (time.time) when the question started to be answered
+        exploration_scores (List[dict]): The confidence, coverage and information gain of each context evaluation, see exploration_control.py
+        evaluated_context (str): The dynamic context at the last context evaluation, used to measure the information gain
+        stop_reason (str): Why the exploration controller stopped the exploration, if it did
     """
     main_prompt: str
     dynamic_context: str
@@ -26,6 +39,16 @@ class State(TypedDict):
     exploration_counter: int
     num_explorations: int
     explored_files: List[str]
+    pending_explorations: List[Tuple[str, str, Future]]
+    batch_prompts: List[str]
+    final_answers: List[str]
+    token_trace: List[dict]
+    run_id: str
+    resume_node: str
+    started_at: float
+    exploration_scores: List[dict]
+    evaluated_context: str
+    stop_reason: str
 
 def list_avaliable_relative_files(base_path: str) -> List[str]:
     """
@@ -64,32 +87,69 @@ def get_exploration_queue(exploration: Dict[str, Dict[str, str]]) -> List[Tuple[
             exploration_queue.append(((datasource + "/" + file).replace("//","/"), prompt))
     return exploration_queue
 
-def render_prompt(prompt_path, prompt_variables):
+# compiled templates by path, reloaded when the file changes
+_templates_cache = {}
+
+def load_template(prompt_path: str) -> jinja2.Template:
+    modified_time = os.path.getmtime(prompt_path)
+    cached = _templates_cache.get(prompt_path)
+    if cached is not None and cached[0] == modified_time:
+        return cached[1]
     with open(prompt_path, encoding="utf-8") as f:
         template = jinja2.Template(f.read())
+    _templates_cache[prompt_path] = (modified_time, template)
+    return template
+
+def render_prompt(prompt_path, prompt_variables):
+    """
+    Renders the prompt template. Templates with blocks named after the prompt segments (static, datasource,
+    question and round) have the blocks rendered in this order, see prompt_assembly.py.
+    """
+    template = load_template(prompt_path)
+    if is_segmented_template(template):
+        return render_segmented_template(template, prompt_variables)
     return template.render(prompt_variables)
 
 
-def format_current_context(state: State) -> str:
+def normalize_prompt(prompt: str) -> str:
     """
-    Formats the current context string.
-    
-    Args:
-        state (State): The current state of the application.
-        
-    Returns:
-        str: The formatted current context string.
+    Normalizes the prompt so small differences (case, whitespaces and final punctuation) don't change cache keys.
+    """
+    return re.sub(r"\s+", " ", prompt).strip().lower().rstrip(".?!").strip()
+
+
+def format_datasources(state: State) -> str:
+    """
+    Formats the avaliable datasources, the part of the current context that doesn't change between rounds.
     """
     datasources = str(state.get("datasources", "no datasources"))
     return f"""
     Avaliable datasources:
     '{datasources}'
+    """
 
+def format_project_notes(state: State) -> str:
+    """
+    Formats the project notes, the part of the current context that changes in every round.
+    """
+    return f"""
     [[Start of Project notes]]
     {state.get('dynamic_context', '')}
     [[End of Project notes]]
     """
 
+def format_current_context(state: State) -> str:
+    """
+    Formats the current context string.
+    
+    Args:
+        state (State): The current state of the application.
+        
+    Returns:
+        str: The formatted current context string.
+    """
+    return format_datasources(state) + format_project_notes(state)
+
 def display_app_graph(app):
     try:
         display(Image(app.get_graph().draw_mermaid_png()))